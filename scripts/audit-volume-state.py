@@ -1,61 +1,69 @@
 #!/usr/bin/env python
 import argparse
 import collections
+import csv
+import fnmatch
 import itertools
 import json
 import os
+import Queue
 import re
-import subprocess
+import sqlite3
 import sys
+import threading
+import time
 
-HV_INVENTORY_SCRIPT = '/home/devoid/projects/hv-inventory.py'
-# Run pdsh or pdcp, report errors and return stdout
-def _pdsh(args, hosts, cmd='pdsh'):
-    pdsh_cmd = [cmd, '-u', '15', '-w', ','.join(hosts)]
-    pdsh_cmd.extend(args)
-    print >> sys.stderr, '%s: %s' % (cmd, ' '.join(args))
-    p = subprocess.Popen(pdsh_cmd, stdout=subprocess.PIPE, stderr=None)
-    return p.stdout
-
-# Process stdout from pdsh assuming that each script returned valid json.
-# Fold that under the hostname that returned it.
-_pdsh_line_rx = re.compile("^([^:]+): (.*)$")
-def dshback_json(fh):
-    hosts = collections.defaultdict(list)
-    for line in fh:
-        m = _pdsh_line_rx.match(line)
-        if not m:
-            print >> sys.stderr, "Error reading line: %s" % line
-        host, part = m.groups()
-        hosts[host].append(part)
-    for host, parts in hosts.iteritems():
-        hosts[host] = json.loads("".join(parts))
-    return dict(hosts)
+import magellan_ssh
+
+DB_HOST = 'm3-p'
+HV_INVENTORY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'hv-inventory.py')
+# Fan-out settings for the hypervisor and itadm collectors; see main()
+COLLECT_OPTIONS = {'workers': 32, 'timeout': 15, 'retries': 1}
+_collect_stats = []
+
+# Run cmd on hosts, yielding (host, parsed output) as each one finishes
+def _collect(hosts, cmd, input=None, parse=None):
+    collector = magellan_ssh.Collector(hosts, cmd, input=input, parse=parse,
+                                       **COLLECT_OPTIONS)
+    print >> sys.stderr, 'collect: %s on %d hosts' % (' '.join(cmd),
+                                                      len(collector.hosts))
+    _collect_stats.append(collector)
+    for host, data in collector:
+        yield host, data
 
 # Get data from hypervisor (iscsiadm and virsh)
-def get_hv_data(hosts):
+def iter_hv_data(hosts):
+    # Feed the inventory script over stdin, no copy step needed
     if os.path.exists(HV_INVENTORY_SCRIPT):
-        _pdsh([HV_INVENTORY_SCRIPT, '/tmp/hv-inventory.py'], hosts, cmd='pdcp')
-    out = _pdsh(['python', '/tmp/hv-inventory.py'], hosts)
-    data = dshback_json(out)
-    return data
+        with open(HV_INVENTORY_SCRIPT) as fh:
+            script = fh.read()
+        return _collect(hosts, ['python', '-'], input=script,
+                        parse=json.loads)
+    return _collect(hosts, ['python', '/tmp/hv-inventory.py'],
+                    parse=json.loads)
+
+def get_hv_data(hosts):
+    return dict(iter_hv_data(hosts))
+
+# Split rows of a DB helper's output as they arrive
+def _db_rows(cmd, delimiter=None):
+    for line in magellan_ssh.get_session(DB_HOST).stream(cmd):
+        if line.strip():
+            yield line.strip().split(delimiter)
 
 # Get instance data from DB
+_state_map = {'active' : 'running', 'shutoff' : 'shutoff',
+              'error' : 'error', 'paused' : 'paused',
+              'suspended' : 'suspended'}
 def _db_instance_data():
-    cmd = ['ssh', 'm3-p', './inventory_all_instances']
-    output = subprocess.check_output(cmd)
-    rows  = [l.split() for l in output.splitlines()]
-    data = []
-    _state_map = {'active' : 'running', 'shutoff' : 'shutoff',
-                  'error' : 'error', 'paused' : 'paused',
-                  'suspended' : 'suspended'}
-    for row in rows:
+    for row in _db_rows(['./inventory_all_instances']):
         domain = "instance-%08x" % int(row[0])
-        data.append({'uuid' : row[1], 'domain' : domain, 'host' : row[2],
-                     'id' : row[0], 'state' : _state_map.get(row[4], row[4])})
-    return data
+        yield {'uuid' : row[1], 'domain' : domain, 'host' : row[2],
+               'id' : row[0], 'state' : _state_map.get(row[4], row[4])}
 
 _volume_id_rx = re.compile("volume-([0-9a-fA-F]{8})")
+_domain_rx = re.compile("instance-([0-9a-fA-F]{8})$")
 def _volume_id_to_id(v):
     m = _volume_id_rx.match(v)
     id = m.groups()
@@ -64,14 +72,11 @@ def _volume_id_to_id(v):
 # Get volume data from db
 _volume_provider_rx = re.compile(
 "(\d+\.\d+\.\d+\.\d+):(\d+),(\d+) iqn.2010-10.org.openstack:(volume-[0-9a-fA-F]{8})")
+_volume_columns = ['id', 'instance_uuid', 'dev', 'user', 'project', 'iqn',
+                   'status']
 def _db_volume_data():
-    cmd = ['ssh', 'm3-p', './inventory_volumes3']
-    output = subprocess.check_output(cmd)
-    rows = [l.split(';') for l in output.splitlines()]
-    columns = ['id', 'instance_uuid', 'dev', 'user', 'project', 'iqn', 'status']
-    volume_data = []
-    for row in rows:
-        data = dict(zip(columns, row))
+    for row in _db_rows(['./inventory_volumes3'], ';'):
+        data = dict(zip(_volume_columns, row))
         ip, port, lun = (None, None, None)
         volume_id = "volume-%08x" % int(data['id'])
         if data['iqn'] != 'None':
@@ -80,27 +85,36 @@ def _db_volume_data():
                 print >> sys.stderr, "Error processing row: %s" % (" ".join(row))
                 continue
             ip, port, lun, volume_id = m.groups()
-        final = {'id' : data['id'], 'instance_uuid' : data['instance_uuid'],
-                 'dev' : data['dev'], 'ip' : ip, 'port' : port, 'lun' : lun,
-                 'volume_id' : volume_id, 'status' : data['status']}
-        volume_data.append(final)
-    return volume_data
+        yield {'id' : data['id'], 'instance_uuid' : data['instance_uuid'],
+               'dev' : data['dev'], 'ip' : ip, 'port' : port, 'lun' : lun,
+               'volume_id' : volume_id, 'status' : data['status'],
+               'user' : data['user'], 'project' : data['project']}
+
+class InstanceIndex(object):
+    """Instances from the DB indexed by uuid."""
+    def __init__(self, instances=()):
+        self.by_uuid = collections.defaultdict(list)
+        for instance in instances:
+            self.add(instance)
+
+    def add(self, instance):
+        self.by_uuid[instance['uuid']].append(instance)
 
 def _join_db_data(instance_data, volume_data):
+    index = InstanceIndex(instance_data)
     volumes = []
     for volume in volume_data:
         instance = {}
         uuid = volume.get('instance_uuid')
-        print volume
         if uuid != 'None':
-            instances = [i for i in instance_data if i['uuid'] == uuid]
+            instances = index.by_uuid.get(uuid, ())
             if len(instances) == 1:
                 instance = instances[0]
             elif len(instances) > 1:
                 print >> sys.stderr, "Multiple instances for volume %s" % (
                     volume['volume_id'])
             else:
-                print "Unable to find instance for %s" % uuid
+                print >> sys.stderr, "Unable to find instance for %s" % uuid
         volumes.append({'volume_id': volume['volume_id'],
                          'id': volume['id'], 'ip': volume['ip'],
                          'port': volume['port'], 'lun': volume['lun'],
@@ -108,8 +122,9 @@ def _join_db_data(instance_data, volume_data):
                          'status' : volume['status'],
                          'instance_uuid': instance.get('uuid', None),
                          'instance_id': instance.get('id', None),
-                         'host': instance.get('host', None)})
-    print volumes[0]
+                         'host': instance.get('host', None),
+                         'user': volume['user'],
+                         'project': volume['project']})
     return volumes
 
 def get_db_data(hosts):
@@ -127,26 +142,31 @@ def _balance_matrix(m):
 #  i  x         x   x    x  x
 # d   x         x        x  x    x
 # div volume_id id  mode ip host vm-uuid dev
+# These are the keys that each type cares about
+VOTE_KEYS = {'t' : ['volume_id'],
+             'd' : ['volume_id', 'ip', 'host', 'instance_id'],
+             'i' : ['volume_id', 'ip', 'host'],
+             'v' : ['volume_id', 'host', 'instance_id']}
+# Now define them in terms of the intersection of two types
+COMPARE_MATRIX = _balance_matrix({'d': {'i': ['volume_id', 'ip', 'host'],
+                                        'v': ['volume_id', 'host',
+                                              'instance_id'],
+                                        't': ['volume_id']},
+                                  'i': {'v': ['volume_id', 'host'],
+                                        't': ['volume_id']},
+                                  'v': {'t': ['volume_id']}})
+# Also include additional data when we match a vote or create a new one
+ADD_DATA = {'d' : ['instance_uuid', 'id', 'status'],
+            'i' : ['mode'],
+            'v' : ['dev'],
+            't' : ['sessions']}
+
 def volume_vote(entry, entry_type, votes):
-    # These are the keys that each type cares about
-    comparisons = {'t' : ['volume_id'],
-                   'd' : ['volume_id', 'ip', 'host', 'instance_id'],
-                   'i' : ['volume_id', 'ip', 'host'],
-                   'v' : ['volume_id', 'host', 'instance_id']}  
-    # Now define them in terms of the intersection of two types
-    compare_matrix = {'d': {'i': ['volume_id', 'ip', 'host'],
-                            'v': ['volume_id', 'host', 'instance_id'],
-                            't': ['volume_id']},
-                      'i': {'v': ['volume_id', 'host'],
-                            't': ['volume_id']},
-                      'v': {'t': ['volume_id']}}
-    compare_matrix = _balance_matrix(compare_matrix)
-    # Also include additional data when we match a vote or create a new one
-    add_data = {'d' : ['instance_uuid', 'id', 'status'],
-                'i' : ['mode'],
-                'v' : ['dev'],
-                't' : ['sessions']}
-    my_comparisons = compare_matrix[entry_type]
+    """Reference implementation: scan every vote for a match.
+
+    Kept to check Reconciler against; quadratic in the number of votes.
+    """
+    my_comparisons = COMPARE_MATRIX[entry_type]
     voted = False
 
     for vote in votes:
@@ -165,7 +185,7 @@ def volume_vote(entry, entry_type, votes):
                         break
         if candidate and not reject:
             vote[entry_type] = entry_type
-            for key in add_data[entry_type]:
+            for key in ADD_DATA[entry_type]:
                 vote[key] = entry[key]
             voted = True
             break
@@ -173,161 +193,1189 @@ def volume_vote(entry, entry_type, votes):
         # ok, we failed to find a match, make a new vote
         vote = { 'd': '-', 'i': '-', 'v' : '-', 't' : '-' }
         vote[entry_type] = entry_type
-        for key in comparisons[entry_type]:
+        for key in VOTE_KEYS[entry_type]:
             vote[key] = entry[key]
-        for key in add_data[entry_type]:
+        for key in ADD_DATA[entry_type]:
             vote[key] = entry[key]
         votes.append(vote)
-    
-def print_results(votes):
-    def _dvi(row):
-        return '%s%s%s%s' % (row['t'], row['d'], row['i'], row['v'])
-    columns = {'TDIV' : _dvi, 'volume_id': None, 'id': None, 'mode': None,
-               'ip': None, 'host': None, 'instance_uuid': None, 'dev': None,
-               'sessions' : None, 'status' : None}
-    sorted_columns = [('TDIV', 3), 
-                      ('volume_id', 15),
-                      ('id', 6),
-                      ('mode', 4),
-                      ('status', 14),
-                      ('ip', 15),
-                      ('host', 7),
-                      ('instance_uuid', 36),
-                      ('dev', 10),
-                      ('sessions', 8)]
-    formatstr = " ".join(map(lambda c: "%%%ds" % c[1], sorted_columns))
-    sorted_columns = map(lambda c: c[0], sorted_columns)
-    print formatstr % tuple(sorted_columns)
-    for data in votes:
-        print formatstr % tuple([columns[c](data) if columns[c] is not None
-                                 else data.get(c, '-') for c in sorted_columns])
 
-# Hack to process hosts like pdsh
-def _evaluate_host_str(host_str):
-    return subprocess.check_output(['/home/desai/mht', '-w', host_str,
-                                    'echo', '%s']).splitlines()
+def hv_entries(host, hv_host_data):
+    """(entry, 'i' or 'v') for each session and block device on host."""
+    for s in hv_host_data['iscsiadm']:
+        entry = {'host': host, 'volume_id': s['volume_id'], 'ip': s['ip'],
+                 'port': s['port'], 'mode': s['mode'], 'lun': s['lun']}
+        yield entry, 'i'
+    for domain in hv_host_data['virsh']:
+        for v in domain['volumes']:
+            entry = {'host': host, 'volume_id': v['volume_id'],
+                     'id': _volume_id_to_id(v['volume_id']),
+                     'instance_id': str(domain['id']), 'dev': v['dev'],
+                     'domain': domain['domain']}
+            yield entry, 'v'
+
+class Reconciler(object):
+    """Fold entries from each source into votes, as volume_vote does.
+
+    Every comparison includes volume_id, so an entry can only join a vote
+    for the same volume; votes are bucketed by volume_id and only that
+    bucket is scanned, in the order the votes were made. Rules are
+    compiled once per entry type into (other type, keys) pairs.
+    """
+    def __init__(self):
+        self.votes = []
+        self._by_volume = collections.defaultdict(list)
+        self._rules = dict((t, COMPARE_MATRIX[t].items())
+                           for t in COMPARE_MATRIX)
+
+    def add(self, entry, entry_type):
+        rules = self._rules[entry_type]
+        bucket = self._by_volume[entry['volume_id']]
+        for vote in bucket:
+            candidate = False
+            for other_entry_type, keys in rules:
+                if vote[other_entry_type] == '-':
+                    continue
+                candidate = True
+                for key in keys:
+                    if key not in vote or vote[key] != entry.get(key):
+                        break
+                else:
+                    continue
+                break
+            else:
+                if candidate:
+                    vote[entry_type] = entry_type
+                    for key in ADD_DATA[entry_type]:
+                        vote[key] = entry[key]
+                    return vote
+        vote = {'d': '-', 'i': '-', 'v': '-', 't': '-'}
+        vote[entry_type] = entry_type
+        for key in VOTE_KEYS[entry_type]:
+            vote[key] = entry[key]
+        for key in ADD_DATA[entry_type]:
+            vote[key] = entry[key]
+        bucket.append(vote)
+        self.votes.append(vote)
+        return vote
+
+    def add_db(self, db_data):
+        for volume in db_data:
+            self.add(volume, 'd')
+
+    def add_hv(self, host, hv_host_data):
+        for entry, entry_type in hv_entries(host, hv_host_data):
+            self.add(entry, entry_type)
+
+    def add_targets(self, it_data):
+        for entry in it_data:
+            self.add(entry, 't')
+
+def _synthetic_data(count):
+    """db, hv and itadm data with about count entries, some inconsistent."""
+    db_data, hv_data, it_data = [], {}, []
+    for n in range(count // 4):
+        volume_id = "volume-%08x" % n
+        host = "cc%d-p" % (n % 504 + 1)
+        ip = "10.0.0.%d" % (n % 2 + 1)
+        db_data.append({'volume_id': volume_id, 'id': str(n), 'ip': ip,
+                        'port': '3260', 'lun': '1', 'dev': 'vdb',
+                        'status': 'in-use', 'instance_uuid': 'uuid-%d' % n,
+                        'instance_id': str(n // 2), 'host': host})
+        hv = hv_data.setdefault(host, {'iscsiadm': [], 'virsh': []})
+        if n % 7:
+            hv['iscsiadm'].append({'volume_id': volume_id, 'ip': ip,
+                                   'port': '3260', 'mode': 'rw', 'lun': '1'})
+        vhost = host if n % 11 else "cc%d-p" % ((n + 1) % 504 + 1)
+        hv_data.setdefault(vhost, {'iscsiadm': [], 'virsh': []})
+        hv_data[vhost]['virsh'].append({'id': n // 2,
+                                        'domain': 'instance-%08x' % (n // 2),
+                                        'volumes': [{'volume_id': volume_id,
+                                                     'dev': 'vdb'}]})
+        if n % 13:
+            it_data.append({'volume_id': volume_id, 'status': 'online',
+                            'sessions': '1'})
+    return db_data, hv_data, it_data
+
+class _ScanReconciler(Reconciler):
+    """Reconciler that folds entries with the volume_vote scan."""
+    def add(self, entry, entry_type):
+        volume_vote(entry, entry_type, self.votes)
+
+def _reconcile(reconciler, db_data, hv_data, it_data):
+    start = time.time()
+    reconciler.add_db(db_data)
+    for host in sorted(hv_data):
+        reconciler.add_hv(host, hv_data[host])
+    reconciler.add_targets(it_data)
+    return time.time() - start
+
+def benchmark(count):
+    """Time Reconciler on synthetic data, checking it against volume_vote."""
+    print "%10s %10s %12s %12s" % ('entries', 'votes', 'seconds',
+                                   'volume_vote')
+    size = 1000
+    while True:
+        size = min(size, count)
+        reconciler = Reconciler()
+        elapsed = _reconcile(reconciler, *_synthetic_data(size))
+        reference = '-'
+        # The quadratic scan is only practical on small inputs.
+        if size <= 4000:
+            scan = _ScanReconciler()
+            reference = "%.3f" % _reconcile(scan, *_synthetic_data(size))
+            if scan.votes != reconciler.votes:
+                raise Exception("Reconciler disagrees with volume_vote at "
+                                "%d entries" % size)
+        print "%10d %10d %12.3f %12s" % (size, len(reconciler.votes),
+                                         elapsed, reference)
+        if size >= count:
+            break
+        size *= 4
+
+CONSISTENT = 'tdiv'
+def _tdiv(row):
+    return '%s%s%s%s' % (row['t'], row['d'], row['i'], row['v'])
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 86400:
+        return "%dd%02dh" % (seconds // 86400, seconds % 86400 // 3600)
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+    return "%dm%02ds" % (seconds // 60, seconds % 60)
+
+_since_rx = re.compile("^(\d+)([smhd])$")
+def _parse_since(text):
+    """Epoch seconds from '90m', '6h', '2d', 'YYYY-MM-DD[THH:MM]' or epoch."""
+    m = _since_rx.match(text)
+    if m:
+        unit = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[m.group(2)]
+        return time.time() - int(m.group(1)) * unit
+    for fmt in ('%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            pass
+    try:
+        return float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Can't parse time %s" % text)
+
+def diff_runs(store, run, started, base, host_set):
+    """Volumes whose votes differ between base and run, with ages.
+
+    Each row is (change, volume_id, was, now, duration): the duration is
+    the time to resolution for a resolved discrepancy and how long it
+    has been open for one that is still there.
+    """
+    old, new = store.run_votes(base), store.run_votes(run)
+    rows = []
+    for volume_id in sorted(set(old) | set(new)):
+        before, after = old.get(volume_id, []), new.get(volume_id, [])
+        if before == after:
+            continue
+        was = ",".join(t for t, v in before) or '-'
+        now = ",".join(t for t, v in after) or '-'
+        bad_before = bool(before) and was != CONSISTENT
+        bad_after = bool(after) and now != CONSISTENT
+        if bad_after and not bad_before:
+            change = 'new'
+        elif bad_before and not bad_after:
+            change = 'resolved'
+        elif not before:
+            change = 'added'
+        elif not after:
+            change = 'removed'
+        else:
+            change = 'changed'
+        duration = '-'
+        record = store.discrepancy(volume_id, started, host_set)
+        if record and (bad_before or bad_after):
+            opened, resolved = record
+            if change == 'resolved' and resolved:
+                duration = _format_duration(resolved - opened)
+            elif bad_after:
+                duration = "open %s" % _format_duration(started - opened)
+        rows.append((change, volume_id, was, now, duration))
+    return rows
+
+def print_diff(rows, base_started):
+    print "changes since %s" % time.strftime('%Y-%m-%d %H:%M:%S',
+                                              time.localtime(base_started))
+    formatstr = "%8s %15s %14s %14s %14s"
+    print formatstr % ('change', 'volume_id', 'was', 'now', 'resolution')
+    for row in rows:
+        print formatstr % row
+    counts = collections.Counter(row[0] for row in rows)
+    print ", ".join("%d %s" % (counts[c], c) for c in sorted(counts)) or \
+        "no changes"
+
+RESULT_COLUMNS = [('TDIV', 3), 
+                  ('volume_id', 15),
+                  ('id', 6),
+                  ('mode', 4),
+                  ('status', 14),
+                  ('ip', 15),
+                  ('host', 7),
+                  ('instance_uuid', 36),
+                  ('dev', 10),
+                  ('sessions', 8)]
+
+class VoteFilter(object):
+    """Which votes to report: host and TDIV are fnmatch patterns."""
+    def __init__(self, only_inconsistent=False, hosts=(), statuses=(),
+                 tdiv=None):
+        self.only_inconsistent = only_inconsistent
+        self.hosts = list(hosts)
+        self.statuses = set(statuses)
+        self.tdiv = tdiv
+
+    def match(self, vote):
+        tdiv = _tdiv(vote)
+        if self.only_inconsistent and tdiv == CONSISTENT:
+            return False
+        if self.tdiv and not fnmatch.fnmatchcase(tdiv, self.tdiv):
+            return False
+        if self.statuses and vote.get('status') not in self.statuses:
+            return False
+        if self.hosts and not any(fnmatch.fnmatchcase(str(vote.get('host')),
+                                                      pattern)
+                                  for pattern in self.hosts):
+            return False
+        return True
+
+class ResultWriter(object):
+    """Write votes one at a time as text, NDJSON or CSV, then a summary.
+
+    Each row is flushed as it is written so a consumer can act on it
+    straight away. The summary counts every vote seen by TDIV; for the
+    machine formats it goes to stderr so stdout holds only rows.
+    """
+    def __init__(self, fmt='text', vote_filter=None, fh=sys.stdout):
+        self.fmt = fmt
+        self.vote_filter = vote_filter or VoteFilter()
+        self.fh = fh
+        self.columns = [c[0] for c in RESULT_COLUMNS]
+        self.counts = collections.Counter()
+        self.written = 0
+        if fmt == 'text':
+            self._format = " ".join("%%%ds" % c[1] for c in RESULT_COLUMNS)
+            print >> fh, self._format % tuple(self.columns)
+        elif fmt == 'csv':
+            self._csv = csv.writer(fh)
+            self._csv.writerow(self.columns)
+
+    def write(self, vote):
+        tdiv = _tdiv(vote)
+        self.counts[tdiv] += 1
+        if not self.vote_filter.match(vote):
+            return
+        self.written += 1
+        row = [tdiv] + [vote.get(c, '-') for c in self.columns[1:]]
+        if self.fmt == 'text':
+            print >> self.fh, self._format % tuple(row)
+        elif self.fmt == 'csv':
+            self._csv.writerow(['' if v is None else v for v in row])
+        else:
+            record = dict((k, v) for k, v in vote.iteritems()
+                          if k not in ('t', 'd', 'i', 'v'))
+            record['TDIV'] = tdiv
+            print >> self.fh, json.dumps(record, sort_keys=True)
+        self.fh.flush()
+
+    def summary(self):
+        fh = self.fh if self.fmt == 'text' else sys.stderr
+        total = sum(self.counts.values())
+        print >> fh, "%d of %d votes shown; %s" % (
+            self.written, total, ", ".join(
+                "%s %d" % (tdiv, count)
+                for tdiv, count in sorted(self.counts.items())))
+
+def print_results(votes, writer=None):
+    writer = writer or ResultWriter()
+    for data in votes:
+        writer.write(data)
+    writer.summary()
 
 _target_name_rx = re.compile(
     "iqn.2010-10.org.openstack:(volume-[0-9a-fA-F]{8})")
-def get_itadm_data(hosts):
-    out = _pdsh(['itadm', 'list-target'], hosts=hosts)
+def _parse_itadm(out):
     data = []
-    for line in out:
+    for line in out.splitlines():
         row = line.split()
-        if len(row) != 4:
+        if len(row) != 3:
             continue
-        m = _target_name_rx.match(row[1])
+        m = _target_name_rx.match(row[0])
         if not m:
-            print >> sys.stderr, "Unable to match iqn string %s" % row[2]
+            print >> sys.stderr, "Unable to match iqn string %s" % row[0]
             continue
         volume_id = m.group(1) 
-        data.append({'volume_id' : volume_id, 'status' : row[2],
-                     'sessions' : row[3]})
+        data.append({'volume_id' : volume_id, 'status' : row[1],
+                     'sessions' : row[2]})
+    return data
+
+def iter_itadm_data(hosts):
+    return _collect(hosts, ['itadm', 'list-target'], parse=_parse_itadm)
+
+def get_itadm_data(hosts):
+    data = []
+    for host, targets in iter_itadm_data(hosts):
+        data.extend(targets)
     return data
+
+def iter_db_data(hosts):
+    yield DB_HOST, get_db_data(hosts)
+
+ITADM_HOSTS = 'v[1,3]-p'
+# Seconds each source's cached data stays usable; see --ttl
+CACHE_TTLS = {'db': 300, 'hv': 900, 'it': 300}
+
+# Schema changes, applied in order to bring a store up to date; the
+# number reached is kept in PRAGMA user_version.
+_STORE_SCHEMA = [
+    (1, ["""CREATE TABLE fetches (source TEXT, host TEXT, fetched REAL,
+                             PRIMARY KEY (source, host))""",
+         """CREATE TABLE db_volumes (host TEXT, volume_id TEXT, id TEXT,
+                                ip TEXT, port TEXT, lun TEXT, dev TEXT,
+                                status TEXT, instance_uuid TEXT,
+                                instance_id TEXT, instance_host TEXT)""",
+         "CREATE INDEX db_volumes_volume ON db_volumes (volume_id)",
+         "CREATE INDEX db_volumes_host ON db_volumes (instance_host)",
+         "CREATE INDEX db_volumes_instance ON db_volumes (instance_uuid)",
+         """CREATE TABLE iscsi_sessions (host TEXT, volume_id TEXT, ip TEXT,
+                                    port TEXT, mode TEXT, lun TEXT)""",
+         "CREATE INDEX iscsi_sessions_volume ON iscsi_sessions (volume_id)",
+         "CREATE INDEX iscsi_sessions_host ON iscsi_sessions (host)",
+         """CREATE TABLE virsh_domains (host TEXT, domain TEXT,
+                                   instance_id INTEGER, state TEXT)""",
+         "CREATE INDEX virsh_domains_host ON virsh_domains (host)",
+         "CREATE INDEX virsh_domains_domain ON virsh_domains (domain)",
+         """CREATE TABLE virsh_devices (host TEXT, domain TEXT,
+                                   volume_id TEXT, dev TEXT, ip TEXT,
+                                   port TEXT, lun TEXT)""",
+         "CREATE INDEX virsh_devices_volume ON virsh_devices (volume_id)",
+         "CREATE INDEX virsh_devices_host ON virsh_devices (host)",
+         "CREATE INDEX virsh_devices_domain ON virsh_devices (domain)",
+         """CREATE TABLE targets (host TEXT, volume_id TEXT, status TEXT,
+                             sessions TEXT)""",
+         "CREATE INDEX targets_volume ON targets (volume_id)",
+         "CREATE INDEX targets_host ON targets (host)"]),
+    (2, ["CREATE TABLE runs (id INTEGER PRIMARY KEY, started REAL, "
+         "hosts INTEGER)",
+         """CREATE TABLE run_votes (run INTEGER, volume_id TEXT, tdiv TEXT,
+                               vote TEXT)""",
+         "CREATE INDEX run_votes_run ON run_votes (run, volume_id)",
+         "CREATE INDEX run_votes_volume ON run_votes (volume_id)",
+         """CREATE TABLE discrepancies (volume_id TEXT, opened REAL,
+                                   resolved REAL)""",
+         "CREATE INDEX discrepancies_volume ON discrepancies "
+         "(volume_id, resolved)"]),
+    (3, ["ALTER TABLE db_volumes ADD COLUMN user TEXT",
+         "ALTER TABLE db_volumes ADD COLUMN project TEXT",
+         "CREATE INDEX db_volumes_user ON db_volumes (user)"]),
+    # Runs and discrepancies only compare within one set of hosts
+    (4, ["ALTER TABLE runs ADD COLUMN host_set TEXT",
+         "ALTER TABLE discrepancies ADD COLUMN host_set TEXT"]),
+]
+_DB_COLUMNS = ['volume_id', 'id', 'ip', 'port', 'lun', 'dev', 'status',
+               'instance_uuid', 'instance_id', 'host', 'user', 'project']
+_ISCSI_COLUMNS = ['volume_id', 'ip', 'port', 'mode', 'lun']
+_DEVICE_COLUMNS = ['volume_id', 'dev', 'ip', 'port', 'lun']
+_TARGET_COLUMNS = ['volume_id', 'status', 'sessions']
+
+def _host_set(hosts):
+    """Key naming a set of hosts, kept with runs and discrepancies."""
+    return ",".join(sorted(set(hosts)))
+
+class AuditStore(object):
+    """Collected data kept in one indexed SQLite file.
+
+    Rows are stored per source and host along with when that host was
+    last fetched; the DB is a single 'host'. Entries older than the
+    source's ttl are stale and fetched again, the rest are read back in
+    the shape the collectors return, so a run only reaches the hosts it
+    needs to. Tables are indexed by volume, host and instance for ad-hoc
+    queries.
+    """
+    def __init__(self, path, ttls=None):
+        self.path = path
+        self.ttls = dict(CACHE_TTLS, **(ttls or {}))
+        self.conn = sqlite3.connect(path)
+        self._upgrade()
+
+    def _upgrade(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for schema_version, statements in _STORE_SCHEMA:
+            if schema_version <= version:
+                continue
+            with self.conn:
+                for statement in statements:
+                    self.conn.execute(statement)
+                self.conn.execute("PRAGMA user_version = %d" %
+                                  schema_version)
+
+    def _tables(self, source):
+        return {'db': ['db_volumes'],
+                'hv': ['iscsi_sessions', 'virsh_domains', 'virsh_devices'],
+                'it': ['targets']}[source]
+
+    def _rows(self, table, columns, host):
+        return [dict(zip(columns, row)) for row in self.conn.execute(
+            "SELECT %s FROM %s WHERE host = ? ORDER BY rowid" % (
+                ", ".join(columns), table), (host,))]
+
+    def load(self, source, host):
+        """host's data for source, shaped as its collector returns it."""
+        if source == 'db':
+            columns = [c if c != 'host' else 'instance_host'
+                       for c in _DB_COLUMNS]
+            rows = self._rows('db_volumes', columns, host)
+            for row in rows:
+                row['host'] = row.pop('instance_host')
+            return rows
+        if source == 'it':
+            return self._rows('targets', _TARGET_COLUMNS, host)
+        domains = self._rows('virsh_domains', ['domain', 'instance_id',
+                                               'state'], host)
+        devices = collections.defaultdict(list)
+        for row in self._rows('virsh_devices', ['domain'] + _DEVICE_COLUMNS,
+                              host):
+            devices[row.pop('domain')].append(row)
+        for domain in domains:
+            domain['id'] = domain.pop('instance_id')
+            domain['volumes'] = devices[domain['domain']]
+        return {'iscsiadm': self._rows('iscsi_sessions', _ISCSI_COLUMNS, host),
+                'virsh': domains}
+
+    def split(self, source, hosts):
+        """({host: data} still fresh, [hosts] stale or missing)."""
+        fetched = dict(self.conn.execute(
+            "SELECT host, fetched FROM fetches WHERE source = ?", (source,)))
+        now = time.time()
+        fresh, stale = {}, []
+        for host in hosts:
+            if now - fetched.get(host, 0) < self.ttls[source]:
+                fresh[host] = self.load(source, host)
+            else:
+                stale.append(host)
+        return fresh, stale
+
+    def _insert(self, table, columns, rows):
+        self.conn.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+            table, ", ".join(columns), ", ".join("?" * len(columns))), rows)
+
+    def update(self, source, data):
+        """Replace the rows of each host in {host: data}."""
+        now = time.time()
+        with self.conn:
+            for host, host_data in data.iteritems():
+                for table in self._tables(source):
+                    self.conn.execute("DELETE FROM %s WHERE host = ?" % table,
+                                      (host,))
+                self.conn.execute("INSERT OR REPLACE INTO fetches VALUES "
+                                  "(?, ?, ?)", (source, host, now))
+                if source == 'db':
+                    self._insert('db_volumes', ['host'] + [
+                        c if c != 'host' else 'instance_host'
+                        for c in _DB_COLUMNS],
+                        [[host] + [row.get(c) for c in _DB_COLUMNS]
+                         for row in host_data])
+                elif source == 'it':
+                    self._insert('targets', ['host'] + _TARGET_COLUMNS,
+                                 [[host] + [row.get(c) for c in
+                                            _TARGET_COLUMNS]
+                                  for row in host_data])
+                else:
+                    self._insert('iscsi_sessions', ['host'] + _ISCSI_COLUMNS,
+                                 [[host] + [row.get(c) for c in
+                                            _ISCSI_COLUMNS]
+                                  for row in host_data['iscsiadm']])
+                    domains = host_data['virsh']
+                    self._insert('virsh_domains', ['host', 'domain',
+                                                   'instance_id', 'state'],
+                                 [[host, d['domain'], d['id'], d.get('state')]
+                                  for d in domains])
+                    self._insert('virsh_devices',
+                                 ['host', 'domain'] + _DEVICE_COLUMNS,
+                                 [[host, d['domain']] + [v.get(c) for c in
+                                                         _DEVICE_COLUMNS]
+                                  for d in domains for v in d['volumes']])
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM fetches")
+            for source in SOURCE_ORDER:
+                for table in self._tables(source):
+                    self.conn.execute("DELETE FROM %s" % table)
+
+    def record_run(self, votes, started, hosts, failed=(),
+                   targets_failed=False):
+        """Store a run's votes and open or close discrepancies.
+
+        A volume is discrepant while any of its votes is not 'tdiv'; the
+        discrepancy opens on the first run that sees it and is resolved
+        by the first run over the same hosts that doesn't. Runs over
+        other hosts neither open nor resolve it, as a volume on a host
+        that wasn't polled would look broken. For the same reason
+        volumes with a vote on a failed host are left as they were, and
+        nothing changes if a target host failed.
+        """
+        host_set = _host_set(hosts)
+        failed = set(failed)
+        unsure = set(v['volume_id'] for v in votes
+                     if targets_failed or v.get('host') in failed)
+        if targets_failed:
+            print >> sys.stderr, "a target host failed: discrepancies " \
+                "left as they were"
+        elif unsure:
+            print >> sys.stderr, "%d volumes on failed hosts: " \
+                "discrepancies left as they were" % len(unsure)
+        discrepant = set(v['volume_id'] for v in votes
+                         if _tdiv(v) != CONSISTENT)
+        with self.conn:
+            run = self.conn.execute("INSERT INTO runs (started, hosts, "
+                                    "host_set) VALUES (?, ?, ?)",
+                                    (started, len(hosts),
+                                     host_set)).lastrowid
+            self.conn.executemany(
+                "INSERT INTO run_votes VALUES (?, ?, ?, ?)",
+                ((run, v['volume_id'], _tdiv(v),
+                  json.dumps(v, sort_keys=True)) for v in votes))
+            open_ids = set(r[0] for r in self.conn.execute(
+                "SELECT volume_id FROM discrepancies WHERE resolved IS NULL "
+                "AND host_set = ?", (host_set,)))
+            if targets_failed:
+                # A volume seen nowhere this run may still have targets
+                unsure = discrepant | open_ids
+            discrepant -= unsure
+            open_ids -= unsure
+            self.conn.executemany(
+                "INSERT INTO discrepancies VALUES (?, ?, NULL, ?)",
+                ((volume_id, started, host_set)
+                 for volume_id in discrepant - open_ids))
+            self.conn.executemany(
+                "UPDATE discrepancies SET resolved = ? "
+                "WHERE volume_id = ? AND resolved IS NULL AND host_set = ?",
+                ((started, volume_id, host_set)
+                 for volume_id in open_ids - discrepant))
+        return run
+
+    def run_before(self, run, when=None):
+        """(id, started) of the run to compare run against.
+
+        That is the newest earlier run over the same hosts, or with when
+        the newest such run at or before when, falling back to the
+        oldest one kept.
+        """
+        host_set = self.conn.execute("SELECT host_set FROM runs WHERE id = ?",
+                                     (run,)).fetchone()[0]
+        if when is not None:
+            row = self.conn.execute("SELECT id, started FROM runs "
+                                    "WHERE id < ? AND host_set = ? "
+                                    "AND started <= ? "
+                                    "ORDER BY id DESC LIMIT 1",
+                                    (run, host_set, when)).fetchone()
+            if row:
+                return row
+            return self.conn.execute("SELECT id, started FROM runs "
+                                     "WHERE id < ? AND host_set = ? "
+                                     "ORDER BY id LIMIT 1",
+                                     (run, host_set)).fetchone()
+        return self.conn.execute("SELECT id, started FROM runs "
+                                 "WHERE id < ? AND host_set = ? "
+                                 "ORDER BY id DESC LIMIT 1",
+                                 (run, host_set)).fetchone()
+
+    def run_votes(self, run):
+        """{volume_id: sorted [(tdiv, vote json)]} for run."""
+        votes = collections.defaultdict(list)
+        for volume_id, tdiv, vote in self.conn.execute(
+                "SELECT volume_id, tdiv, vote FROM run_votes WHERE run = ?",
+                (run,)):
+            votes[volume_id].append((tdiv, vote))
+        for rows in votes.itervalues():
+            rows.sort()
+        return votes
+
+    def discrepancy(self, volume_id, before, host_set):
+        """(opened, resolved) of volume's newest discrepancy by before."""
+        return self.conn.execute("SELECT opened, resolved FROM discrepancies "
+                                 "WHERE volume_id = ? AND opened <= ? "
+                                 "AND host_set = ? "
+                                 "ORDER BY opened DESC LIMIT 1",
+                                 (volume_id, before, host_set)).fetchone()
+
+    def mark(self, volume_id, discrepant, when, host_set):
+        """Open or resolve volume's discrepancy as of when."""
+        with self.conn:
+            opened = self.conn.execute(
+                "SELECT 1 FROM discrepancies WHERE volume_id = ? "
+                "AND resolved IS NULL AND host_set = ?",
+                (volume_id, host_set)).fetchone()
+            if discrepant and not opened:
+                self.conn.execute("INSERT INTO discrepancies VALUES "
+                                  "(?, ?, NULL, ?)",
+                                  (volume_id, when, host_set))
+            elif opened and not discrepant:
+                self.conn.execute("UPDATE discrepancies SET resolved = ? "
+                                  "WHERE volume_id = ? AND resolved IS NULL "
+                                  "AND host_set = ?",
+                                  (when, volume_id, host_set))
+
+    def _select(self, sql, values):
+        """Rows of sql with each 'IN (?)' expanded to the list values."""
+        values = list(values)
+        if not values:
+            return []
+        count = sql.count('IN (?)')
+        sql = sql.replace('IN (?)', 'IN (%s)' % ", ".join("?" * len(values)))
+        return self.conn.execute(sql, values * count).fetchall()
+
+    def volume_hosts(self, volume_ids):
+        """Hypervisors last seen with a session or device for volume_ids."""
+        return set(r[0] for r in self._select(
+            "SELECT host FROM iscsi_sessions WHERE volume_id IN (?) "
+            "UNION SELECT host FROM virsh_devices WHERE volume_id IN (?)",
+            volume_ids))
+
+    def domain_volumes(self, domains):
+        """[(volume_id, host)] last seen attached to one of domains."""
+        return self._select("SELECT volume_id, host FROM virsh_devices "
+                            "WHERE domain IN (?)", domains)
+
+    def domain_hosts(self, domains):
+        """Hypervisors last seen running one of domains."""
+        return set(r[0] for r in self._select(
+            "SELECT host FROM virsh_domains WHERE domain IN (?)", domains))
+
+    def query(self, sql, fh=sys.stdout):
+        """Run an ad-hoc query and print the rows tab separated."""
+        cursor = self.conn.execute(sql)
+        if cursor.description:
+            print >> fh, "\t".join(c[0] for c in cursor.description)
+        for row in cursor:
+            print >> fh, "\t".join("-" if v is None else unicode(v)
+                                   for v in row)
+
+def _cached_source(store, source, hosts, fetch):
+    """(host, data) items: fresh ones from the store, the rest from fetch."""
+    if store is None:
+        return fetch(hosts), hosts
+    fresh, stale = store.split(source, hosts)
+    print >> sys.stderr, '%s: %d cached, %d to fetch' % (source, len(fresh),
+                                                         len(stale))
+    items = fresh.items()
+    if stale:
+        return itertools.chain(items, fetch(stale)), stale
+    return iter(items), stale
+
+def _parse_ttl(text):
+    try:
+        source, seconds = text.split('=')
+        seconds = int(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected SOURCE=SECONDS, got %s" %
+                                         text)
+    if source not in CACHE_TTLS:
+        raise argparse.ArgumentTypeError("Unknown source %s, expected one "
+                                         "of %s" % (source, ", ".join(
+                                             sorted(CACHE_TTLS))))
+    return source, seconds
+
+_DONE = object()
+_FAILED = object()
+
+class ConcurrentSources(object):
+    """Drain several (key, data) iterators at once, one thread each.
+
+    Iterating yields (source, key, data) in arrival order and
+    (source, None, _DONE) once a source is exhausted. An exception in a
+    source is raised again in the consumer.
+    """
+    def __init__(self):
+        self.sources = []
+        self.timings = {}
+        self.counts = {}
+
+    def add(self, name, items):
+        self.sources.append((name, items))
+
+    def _drain(self, name, items, queue):
+        start = time.time()
+        self.counts[name] = 0
+        try:
+            for key, data in items:
+                self.counts[name] += 1
+                queue.put((name, key, data))
+        except Exception:
+            self.timings[name] = time.time() - start
+            queue.put((name, _FAILED, sys.exc_info()))
+        else:
+            self.timings[name] = time.time() - start
+            queue.put((name, None, _DONE))
+
+    def __iter__(self):
+        queue = Queue.Queue()
+        for name, items in self.sources:
+            thread = threading.Thread(target=self._drain,
+                                      args=(name, items, queue))
+            thread.daemon = True
+            thread.start()
+        running = len(self.sources)
+        while running:
+            name, key, data = queue.get()
+            if key is _FAILED:
+                raise data[0], data[1], data[2]
+            if data is _DONE:
+                running -= 1
+            yield name, key, data
+
+    def print_timings(self, fh=sys.stderr):
+        print >> fh, "  ".join("%s: %d in %.1fs" % (
+            name, self.counts.get(name, 0), self.timings.get(name, 0))
+            for name, items in self.sources)
+
+# Sources fold in this order so votes come out as they would from a serial
+# run; data from a later source waits until every earlier one is done.
+SOURCE_ORDER = ['db', 'hv', 'it']
+
+def reconcile(sources):
+    """Fold (source, key, data) items into a Reconciler as they arrive.
+
+    Returns the reconciler and the data collected from each source.
+    """
+    reconciler = Reconciler()
+    collected = dict((name, {}) for name in SOURCE_ORDER)
+    apply = {'db': lambda key, data: reconciler.add_db(data),
+             'hv': reconciler.add_hv,
+             'it': lambda key, data: reconciler.add_targets(data)}
+    held = dict((name, []) for name in SOURCE_ORDER)
+    done = set()
+    def ready(name):
+        return done.issuperset(SOURCE_ORDER[:SOURCE_ORDER.index(name)])
+    for name, key, data in sources:
+        if data is _DONE:
+            done.add(name)
+            for later in SOURCE_ORDER:
+                if held[later] and ready(later):
+                    for item in held[later]:
+                        apply[later](*item)
+                    held[later] = []
+            continue
+        collected[name][key] = data
+        if ready(name):
+            apply[name](key, data)
+        else:
+            held[name].append((key, data))
+    return reconciler, collected
         
+def _volume_name(text):
+    """volume-xxxxxxxx from that name or a decimal DB id."""
+    if text.startswith('volume-'):
+        return text
+    try:
+        return "volume-%08x" % int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Not a volume: %s" % text)
+
+class AuditTarget(object):
+    """The volumes, instances and users an audit is narrowed to.
+
+    resolve() turns them into the hypervisors to query. The DB gives
+    each volume's instance and that instance's host; the store adds the
+    hosts where the last audit saw a session, block device or domain, so
+    stale attachments the DB no longer knows about are still looked at.
+    """
+    def __init__(self, volumes=(), instances=(), users=()):
+        self.volume_ids = set(volumes)
+        self.users = set(users)
+        self.uuids = set()
+        self.instance_ids = set()
+        for instance in instances:
+            m = _domain_rx.match(instance)
+            if m:
+                self.instance_ids.add(str(int(m.group(1), 16)))
+            elif instance.isdigit():
+                self.instance_ids.add(instance)
+            else:
+                self.uuids.add(instance)
+
+    def resolve(self, db_data, store=None):
+        """Sorted hypervisors holding anything in the target."""
+        hosts = set()
+        for row in db_data:
+            if (row.get('user') in self.users or
+                    row['instance_uuid'] in self.uuids or
+                    row['instance_id'] in self.instance_ids):
+                # Everything attached to the instance belongs to it
+                self.volume_ids.add(row['volume_id'])
+                if row['instance_id']:
+                    self.instance_ids.add(row['instance_id'])
+            elif row['volume_id'] not in self.volume_ids:
+                continue
+            if row['host']:
+                hosts.add(row['host'])
+        if store:
+            domains = ["instance-%08x" % int(i) for i in self.instance_ids]
+            for volume_id, host in store.domain_volumes(domains):
+                self.volume_ids.add(volume_id)
+                hosts.add(host)
+            hosts.update(store.domain_hosts(domains))
+            hosts.update(store.volume_hosts(self.volume_ids))
+        return sorted(hosts)
+
+    def match(self, vote):
+        return (vote['volume_id'] in self.volume_ids or
+                str(vote.get('instance_id')) in self.instance_ids)
+
+class IncrementalReconciler(object):
+    """Reconciled votes kept per volume and refolded only where data changes.
+
+    Every comparison includes volume_id, so a volume's votes depend only
+    on its own entries. Each update replaces one source's data for one
+    host and refolds just the volumes that host had or has, in the same
+    d, i/v, t order as a full run, with hosts in sorted order.
+    """
+    def __init__(self):
+        # volume_id -> source -> host -> [(entry, entry_type)]
+        self.entries = collections.defaultdict(
+            lambda: dict((name, {}) for name in SOURCE_ORDER))
+        self.host_volumes = {}
+        self.votes = {}
+
+    def _entries(self, source, host, data):
+        if source == 'db':
+            return [(row, 'd') for row in data]
+        if source == 'hv':
+            return list(hv_entries(host, data))
+        return [(row, 't') for row in data]
+
+    def _refold(self, volume_id):
+        reconciler = Reconciler()
+        sources = self.entries[volume_id]
+        for name in SOURCE_ORDER:
+            for host in sorted(sources[name]):
+                for entry, entry_type in sources[name][host]:
+                    reconciler.add(entry, entry_type)
+        return reconciler.votes
+
+    def update(self, source, host, data):
+        """Replace source's data for host; [(volume_id, old, new)] changed."""
+        by_volume = collections.defaultdict(list)
+        for entry, entry_type in self._entries(source, host, data):
+            by_volume[entry['volume_id']].append((entry, entry_type))
+        affected = self.host_volumes.get((source, host), set())
+        for volume_id in affected:
+            self.entries[volume_id][source].pop(host, None)
+        for volume_id, entries in by_volume.iteritems():
+            self.entries[volume_id][source][host] = entries
+        self.host_volumes[(source, host)] = set(by_volume)
+        changes = []
+        for volume_id in affected | set(by_volume):
+            old = self.votes.get(volume_id, [])
+            new = self._refold(volume_id)
+            if not new:
+                self.votes.pop(volume_id, None)
+                self.entries.pop(volume_id, None)
+            else:
+                self.votes[volume_id] = new
+            if old != new:
+                changes.append((volume_id, old, new))
+        return changes
+
+class AuditDaemon(object):
+    """Poll hypervisors in rolling batches and report volumes that change.
+
+    Every interval seconds the next batch_size hosts are queried, so the
+    load on the fleet stays fixed however large it is; the DB and itadm
+    are re-read every db_interval and it_interval seconds. Events are
+    only printed once the first full sweep of the hosts is done, so that
+    sweep acts as the baseline; hosts that failed in a sweep are listed
+    at its end and picked up again on the next one.
+    """
+    def __init__(self, hosts, store=None, batch_size=16, interval=30,
+                 db_interval=600, it_interval=120, fmt='text',
+                 fh=sys.stdout):
+        self.hosts = hosts
+        self.host_set = _host_set(hosts)
+        self.fmt = fmt
+        self.store = store
+        self.batch_size = batch_size
+        self.interval = interval
+        self.intervals = {'db': db_interval, 'it': it_interval}
+        self.fh = fh
+        self.state = IncrementalReconciler()
+        self.failed = set()
+        self.last = {'db': 0, 'it': 0}
+        self.baseline = False
+
+    def _apply(self, source, host, data):
+        now = time.time()
+        if self.store:
+            self.store.update(source, {host: data})
+        changes = self.state.update(source, host, data)
+        if not self.baseline:
+            return
+        for volume_id, old, new in sorted(changes):
+            was = ",".join(sorted(_tdiv(v) for v in old)) or '-'
+            now_tdiv = ",".join(sorted(_tdiv(v) for v in new)) or '-'
+            if self.fmt == 'text':
+                print >> self.fh, "%s %15s %14s -> %-14s %s:%s" % (
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+                    volume_id, was, now_tdiv, source, host)
+            else:
+                self._event({'time': now, 'volume_id': volume_id,
+                             'was': was, 'now': now_tdiv, 'source': source,
+                             'host': host})
+            if self.store:
+                self.store.mark(volume_id, bool(new) and any(
+                    _tdiv(v) != CONSISTENT for v in new), now,
+                    self.host_set)
+        self.fh.flush()
+
+    def _event(self, event):
+        if self.fmt == 'csv':
+            csv.writer(self.fh).writerow([event[k] for k in (
+                'time', 'volume_id', 'was', 'now', 'source', 'host')])
+        else:
+            print >> self.fh, json.dumps(event, sort_keys=True)
+
+    def _poll_sources(self):
+        sources = [('db', lambda: iter_db_data(self.hosts)),
+                   ('it', lambda: iter_itadm_data(
+                       magellan_ssh.expand_hosts(ITADM_HOSTS)))]
+        for name, fetch in sources:
+            now = time.time()
+            if now - self.last[name] < self.intervals[name]:
+                continue
+            try:
+                for host, data in fetch():
+                    self._apply(name, host, data)
+            except Exception, e:
+                # Leave last alone so the next batch tries again
+                print >> sys.stderr, "%s: poll failed, retrying: %s" % (
+                    name, e)
+                continue
+            self.last[name] = now
+
+    def _batches(self):
+        """Yield (batch, True if it ends a sweep of all hosts)."""
+        while True:
+            for i in range(0, len(self.hosts), self.batch_size):
+                yield (self.hosts[i:i + self.batch_size],
+                       i + self.batch_size >= len(self.hosts))
+
+    def _end_sweep(self):
+        if not self.baseline:
+            self.baseline = True
+            discrepant = len([v for v in self.state.votes.itervalues()
+                              if any(_tdiv(x) != CONSISTENT for x in v)])
+            print >> self.fh, "baseline: %d volumes, %d discrepant" % (
+                len(self.state.votes), discrepant)
+            self.fh.flush()
+        if self.failed:
+            print >> sys.stderr, "sweep: %d of %d hosts failed: %s" % (
+                len(self.failed), len(self.hosts),
+                ",".join(sorted(self.failed)))
+        self.failed = set()
+
+    def run(self):
+        for batch, last in self._batches():
+            start = time.time()
+            self._poll_sources()
+            polled = set()
+            for host, data in iter_hv_data(batch):
+                self._apply('hv', host, data)
+                polled.add(host)
+            del _collect_stats[:]
+            self.failed.update(set(batch) - polled)
+            if last:
+                self._end_sweep()
+            time.sleep(max(0, self.interval - (time.time() - start)))
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--clear-cache', action='store_true',
                         help='Clear the cache before running.')
     parser.add_argument('-n', '--no-cache', action='store_true',
-                        help='Do not populate the cache on this run.')
+                        help='Do not use or populate the cache on this run.')
+    parser.add_argument('--ttl', type=_parse_ttl, action='append', default=[],
+                        metavar='SOURCE=SECONDS',
+                        help='Use cached data for SOURCE (db, hv or it) '
+                             'while younger than SECONDS (defaults: %s).' %
+                             ", ".join("%s=%d" % i for i in
+                                       sorted(CACHE_TTLS.items())))
     parser.add_argument('-d', '--cache-dir', type=str,
                         help='Directory for cache data.')
     parser.add_argument('-H', '--hosts', type=str,
                         help='Hosts to gather this info on.') 
+    parser.add_argument('--workers', type=int,
+                        default=COLLECT_OPTIONS['workers'],
+                        help='Hosts queried at once (default %(default)s).')
+    parser.add_argument('--timeout', type=int,
+                        default=COLLECT_OPTIONS['timeout'],
+                        help='Seconds to wait for each host '
+                             '(default %(default)s).')
+    parser.add_argument('--retries', type=int,
+                        default=COLLECT_OPTIONS['retries'],
+                        help='Times to retry hosts that failed '
+                             '(default %(default)s).')
+    parser.add_argument('--host-stats', action='store_true',
+                        help='Print per-host latency of each collection.')
+    parser.add_argument('--diff', action='store_true',
+                        help='Only report volumes that changed since the '
+                             'previous run (or --since).')
+    parser.add_argument('--since', type=_parse_since, metavar='TIME',
+                        help='With --diff, compare against the last run at '
+                             'or before TIME (2d, 6h, 2015-03-01, ...).')
+    parser.add_argument('--volume', type=_volume_name, action='append',
+                        default=[], metavar='VOLUME',
+                        help='Only audit this volume (volume-xxxxxxxx or DB '
+                             'id); may be repeated.')
+    parser.add_argument('--instance', action='append', default=[],
+                        metavar='INSTANCE',
+                        help='Only audit the volumes of this instance (uuid, '
+                             'id or instance-xxxxxxxx); may be repeated.')
+    parser.add_argument('--user', action='append', default=[],
+                        help='Only audit the volumes of this user; may be '
+                             'repeated.')
+    parser.add_argument('--format', choices=['text', 'ndjson', 'csv'],
+                        default='text',
+                        help='Output format for results and daemon events '
+                             '(default %(default)s).')
+    parser.add_argument('--only-inconsistent', action='store_true',
+                        help="Skip votes whose TDIV is 'tdiv'.")
+    parser.add_argument('--filter-host', action='append', default=[],
+                        metavar='PATTERN',
+                        help='Only show votes whose host matches PATTERN; '
+                             'may be repeated.')
+    parser.add_argument('--status', action='append', default=[],
+                        help='Only show votes with this status; may be '
+                             'repeated.')
+    parser.add_argument('--tdiv', metavar='PATTERN',
+                        help="Only show votes whose TDIV matches PATTERN, "
+                             "e.g. '-d??' or '*-'.")
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep polling hosts in rolling batches and '
+                             'print volumes whose state changes.')
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='With --daemon, hosts polled per batch '
+                             '(default %(default)s).')
+    parser.add_argument('--poll-interval', type=int, default=30,
+                        help='With --daemon, seconds between batches '
+                             '(default %(default)s).')
+    parser.add_argument('--db-interval', type=int, default=600,
+                        help='With --daemon, seconds between DB reads '
+                             '(default %(default)s).')
+    parser.add_argument('--itadm-interval', type=int, default=120,
+                        help='With --daemon, seconds between itadm reads '
+                             '(default %(default)s).')
+    parser.add_argument('--query', metavar='SQL',
+                        help='Run SQL against the audit store and exit.')
+    parser.add_argument('--benchmark', type=int, metavar='N',
+                        help='Time reconciliation of N synthetic entries '
+                             'and exit.')
     options = parser.parse_args()
+    if options.benchmark:
+        benchmark(options.benchmark)
+        return
+    if options.diff and options.no_cache:
+        parser.error("--diff needs the audit store; drop --no-cache")
+    if options.diff and (options.volume or options.instance or options.user):
+        parser.error("--diff compares full runs; it can't be filtered")
+    COLLECT_OPTIONS.update(workers=options.workers, timeout=options.timeout,
+                           retries=options.retries)
     cache_dir = '/tmp/magellan-volume-state-audit'
-    cache_files = {'db.json': None, 'hv.json': None, 'hv.hosts.json': None,
-                   'it.json': None}
     hosts = 'cc[1-504]-p'
     if options.hosts:
         hosts = options.hosts
     if options.cache_dir:
         cache_dir = options.cache_dir
-    for f in cache_files.keys():
-        cache_files[f] = os.path.join(cache_dir, f)
-    
-    # Remove files only
-    if options.clear_cache:
-        for filename in cache_files.values():
-            if os.path.exists(filename):
-                os.remove(filename)
-    
-    # mht has issues with multiple patterns comma delimited
-    hosts = list(itertools.chain(*map(_evaluate_host_str, hosts.split(','))))
-    db_data = None
-    hv_data = None
-    it_data = None
-    # Now try to get data from cache
-    if not options.no_cache:
+    hosts = magellan_ssh.expand_hosts(hosts)
+    store = None
+    if not options.no_cache or options.query:
         if not os.path.exists(cache_dir):
             os.mkdir(cache_dir)
-        missing = {}
-        redo_all = False
-        # Fail if files are missing
-        for key, filename in cache_files.iteritems():
-            if not os.path.exists(filename):
-                missing[key] = True
-        # Fail if we don't have the right hosts
-        if 'hv.hosts.json' not in missing:
-            with open(cache_files['hv.hosts.json'], 'r') as fh:
-                cached_hosts = json.load(fh)
-                for host in hosts:
-                    if host not in cached_hosts:
-                        redo_all = True 
-                        break
-        # Ok, load from cached data
-        if not redo_all and 'hv.json' not in missing:
-            with open(cache_files['hv.json'], 'r') as fh:
-                hv_data = json.load(fh)
-        if not redo_all and 'db.json' not in missing:
-            with open(cache_files['db.json'], 'r') as fh:
-                db_data = json.load(fh)
-        if not redo_all and 'it.json' not in missing:
-            with open(cache_files['it.json'], 'r') as fh:
-                it_data = json.load(fh)
-    # If we didn't load the data, make it now, and mabye cache it
-    if hv_data is None:
-        hv_data = get_hv_data(hosts)
-        if not options.no_cache:
-            with open(os.path.join(cache_dir, 'hv.json'), 'w') as fh:
-                json.dump(hv_data, fh)
-    if db_data is None:
-        db_data = get_db_data(hosts)
-        if not options.no_cache:
-            with open(os.path.join(cache_dir, 'db.json'), 'w') as fh:
-                json.dump(db_data, fh)
-    if it_data is None:
-        it_data = get_itadm_data(['v[1,3]-p'])
-        if not options.no_cache:
-            with open(os.path.join(cache_dir, 'it.json'), 'w') as fh:
-                json.dump(it_data, fh)
-    if not options.no_cache:
-        with open(os.path.join(cache_dir, 'hv.hosts.json'), 'w') as fh:
-            json.dump(hosts, fh)
-    
-    # Now start processing the data
-    votes = []
-    for volume in db_data:
-        volume_vote(volume, 'd', votes)
-    for host, hv_host_data in hv_data.iteritems():
-        iscsi_sessions = hv_host_data['iscsiadm']
-        for s in hv_host_data['iscsiadm']:
-            entry = {'host': host, 'volume_id': s['volume_id'], 'ip': s['ip'],
-                     'port': s['port'], 'mode': s['mode'], 'lun': s['lun']}
-            volume_vote(entry, 'i', votes)
-        domains = hv_host_data['virsh'] 
-        for domain in domains:
-            for v in domain['volumes']:
-                entry = {'host': host, 'volume_id': v['volume_id'],
-                         'id': _volume_id_to_id(v['volume_id']),
-                         'instance_id': str(domain['id']), 'dev': v['dev'],
-                         'domain': domain['domain']}
-                volume_vote(entry, 'v', votes)
-    for entry in it_data:
-        volume_vote(entry, 't', votes)
+        store = AuditStore(os.path.join(cache_dir, 'audit.db'),
+                           ttls=dict(options.ttl))
+        if options.query:
+            store.query(options.query)
+            return
+        if options.clear_cache:
+            store.clear()
+
+    if options.daemon:
+        daemon = AuditDaemon(hosts, store=store, fmt=options.format,
+                             batch_size=options.batch_size,
+                             interval=options.poll_interval,
+                             db_interval=options.db_interval,
+                             it_interval=options.itadm_interval)
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    started = time.time()
+    target = None
+    db_source = lambda h: iter_db_data(hosts)
+    if options.volume or options.instance or options.user:
+        # Narrow the hosts to those involved, always with live data
+        target = AuditTarget(options.volume, options.instance, options.user)
+        if store:
+            store.ttls = dict.fromkeys(CACHE_TTLS, 0)
+        db_items = list(iter_db_data(hosts))
+        involved = target.resolve(db_items[0][1], store)
+        if options.hosts:
+            involved = [h for h in involved if h in set(hosts)]
+        hosts = involved
+        print >> sys.stderr, 'auditing %d volumes on %d hosts: %s' % (
+            len(target.volume_ids), len(hosts), ",".join(hosts))
+        db_source = lambda h: iter(db_items)
+
+    # Fetch whatever isn't freshly cached, all sources at once
+    sources = ConcurrentSources()
+    stale = {}
+    for name, source_hosts, fetch in [
+            ('db', [DB_HOST], db_source),
+            ('hv', hosts, iter_hv_data),
+            ('it', magellan_ssh.expand_hosts(ITADM_HOSTS), iter_itadm_data)]:
+        items, stale[name] = _cached_source(store, name, source_hosts, fetch)
+        sources.add(name, items)
+    reconciler, collected = reconcile(sources)
+    sources.print_timings()
+    if store:
+        for name in SOURCE_ORDER:
+            store.update(name, dict((host, collected[name][host])
+                                    for host in stale[name]
+                                    if host in collected[name]))
+    votes = reconciler.votes
+    if target:
+        # A partial run says nothing about the rest of the fleet, so it
+        # is not recorded in the history.
+        votes = [v for v in votes if target.match(v)]
+    elif store:
+        # Hosts fetched this run that still failed after retries
+        failed = dict((name, set(stale[name]) - set(collected[name]))
+                      for name in ('hv', 'it'))
+        run = store.record_run(votes, started, hosts, failed=failed['hv'],
+                               targets_failed=bool(failed['it']))
     
-    print_results(votes)     
+    if options.diff:
+        base = store.run_before(run, when=options.since)
+        if not base:
+            print >> sys.stderr, "No earlier run over the same hosts to " \
+                                 "compare against."
+            return
+        print_diff(diff_runs(store, run, started, base[0],
+                             _host_set(hosts)), base[1])
+    else:
+        print_results(votes, ResultWriter(options.format, VoteFilter(
+            options.only_inconsistent, options.filter_host, options.status,
+            options.tdiv)))
+    if options.host_stats:
+        for collector in _collect_stats:
+            collector.print_stats()
                 
 if __name__ == '__main__':
     main()
@@ -4,19 +4,26 @@ import os
 import re
 import subprocess
 import sys
+import xml.etree.ElementTree as ElementTree
 """
 hv-inventory.py 
 This script runs on hypervisors and queries libvirt and iscsiadm for
 volume information and returns this in a JSON format.
+
+Domains and their disks are read in one pass from libvirt's runtime
+status files; if those can't be read the virsh CLI is used instead.
 """
 
+LIBVIRT_RUN_DIR = '/var/run/libvirt/qemu'
+
 
 domain_rx = re.compile("instance-([0-9a-fA-F]{8})")
 def _dom_to_id(domain):
     m = domain_rx.match(domain)
     if not m:
-        print >> sys.stder, "Invalid domain name %s" % domain
-    id = m.groups()
+        print >> sys.stderr, "Invalid domain name %s" % domain
+        return None
+    id = m.group(1)
     return int("0x%s" % id, 16)
 
 def get_virsh_domains():
@@ -30,7 +37,7 @@ _iscsi_location_rx = re.compile(
 def _parse_iscsi_location(loc):
     match = _iscsi_location_rx.match(loc)
     if not match:
-        print 'ERROR matching rx for %s' % loc
+        print >> sys.stderr, 'ERROR matching rx for %s' % loc
         return
     ip, port, volume_id, lun = match.groups()
     return {'ip' : ip, 'port' : port, 'volume_id' : volume_id, 'lun' : lun}
@@ -45,10 +52,52 @@ def get_virsh_volumes(domain):
             continue
         dev_name, location = row
         volume = _parse_iscsi_location(location)
-        volume['dev'] = dev_name
-        output.append(volume)
+        if volume:
+            volume['dev'] = dev_name
+            output.append(volume)
     return output
 
+def _disk_volumes(domain_xml):
+    """Volumes of a <domain> element, as get_virsh_volumes returns them."""
+    output = []
+    for disk in domain_xml.findall('devices/disk'):
+        source, target = disk.find('source'), disk.find('target')
+        if source is None or target is None:
+            continue
+        location = source.get('dev') or source.get('file')
+        if not location or _local_disk_rx.match(location):
+            continue
+        volume = _parse_iscsi_location(location)
+        if volume:
+            volume['dev'] = target.get('dev')
+            output.append(volume)
+    return output
+
+def get_runtime_domains(run_dir=LIBVIRT_RUN_DIR):
+    """Running domains with their volumes, without forking virsh.
+
+    libvirt keeps a <domstatus> file per running domain in run_dir; this
+    reads them all at once. Returns None if they can't be read, so the
+    caller can fall back to virsh.
+    """
+    try:
+        names = sorted(n for n in os.listdir(run_dir) if n.endswith('.xml'))
+        output = []
+        for name in names:
+            status = ElementTree.parse(os.path.join(run_dir, name)).getroot()
+            domain_xml = status.find('domain')
+            if status.tag != 'domstatus' or domain_xml is None:
+                continue
+            domain = domain_xml.findtext('name')
+            output.append({'domain' : domain, 'id' : _dom_to_id(domain),
+                           'state' : status.get('state'),
+                           'volumes' : _disk_volumes(domain_xml)})
+        return output
+    except (OSError, IOError, ElementTree.ParseError), e:
+        print >> sys.stderr, "Reading %s failed, using virsh: %s" % (
+            run_dir, e)
+        return None
+
 _iscsi_session_rx = re.compile(
 "(\w+): \[(\d+)\] (\d+\.\d+\.\d+\.\d+):(\d+),(\d+) iqn.2010-10.org.openstack:(volume-[0-9a-fA-F]{8})")
 def get_iscsiadm_data():
@@ -61,15 +110,20 @@ def get_iscsiadm_data():
         m = _iscsi_session_rx.match(line)
         if not m:
             print >> sys.stderr, "Error processing line: %s" % line
+            continue
         mode, id, ip, port, lun, volume_id = m.groups()
         iscsi_data.append({'ip' : ip, 'port' : port, 'mode' : mode,
                            'lun' : lun, 'volume_id' : volume_id})
     return iscsi_data
 
 def main():
-    virsh_data = get_virsh_domains()
-    for row in virsh_data:
-        row['volumes'] = get_virsh_volumes(row['domain'])
+    virsh_data = None
+    if '--virsh' not in sys.argv[1:]:
+        virsh_data = get_runtime_domains()
+    if virsh_data is None:
+        virsh_data = get_virsh_domains()
+        for row in virsh_data:
+            row['volumes'] = get_virsh_volumes(row['domain'])
     iscsiadm_data = get_iscsiadm_data()
     print json.dumps({'virsh' : virsh_data, 'iscsiadm' : iscsiadm_data})
 
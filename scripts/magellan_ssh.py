@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+"""
+magellan_ssh.py
+Persistent, multiplexed ssh sessions shared by the volume tools. Each host
+gets one ControlMaster connection; every command after the first rides on
+it, with an optional per-command timeout and latency accounting.
+
+Collector runs one command across many hosts (pdsh style host ranges
+such as cc[1-504]-p) with a bounded worker pool.
+"""
+import atexit
+import collections
+import itertools
+import os
+import Queue
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CONNECT_TIMEOUT = 10
+# Per-command timeout in seconds for sessions created without their own
+DEFAULT_TIMEOUT = None
+CONTROL_PERSIST = 600
+# Recent commands kept per session; totals cover every command
+HISTORY_LENGTH = 1000
+
+_lock = threading.RLock()
+_control_path_dir = None
+_sessions = {}
+_listeners = []
+
+
+class SessionTimeout(Exception):
+    """A remote command ran longer than its timeout and was killed."""
+    def __init__(self, host, cmd, timeout):
+        self.host = host
+        self.cmd = cmd
+        self.timeout = timeout
+        Exception.__init__(self, "%s: '%s' timed out after %ss" % (
+            host, " ".join(cmd), timeout))
+
+
+def _control_dir():
+    global _control_path_dir
+    with _lock:
+        if _control_path_dir is None:
+            _control_path_dir = tempfile.mkdtemp(prefix='mssh-')
+        return _control_path_dir
+
+
+class Session(object):
+    """One multiplexed ssh connection to host."""
+    def __init__(self, host, timeout=None, options=None, multiplex=True):
+        self.host = host
+        self.timeout = timeout
+        self.options = options if options else []
+        # One-shot sessions skip the extra handshake of a master.
+        self.multiplex = multiplex
+        self.control_path = os.path.join(_control_dir(), host)
+        self.history = collections.deque(maxlen=HISTORY_LENGTH)
+        # [commands, total seconds, max seconds, failures]
+        self.totals = [0, 0.0, 0.0, 0]
+        self._connected = False
+        self._connect_lock = threading.Lock()
+
+    def ssh_args(self):
+        """ssh argv prefix that reuses the master connection."""
+        args = ['ssh']
+        if self.multiplex:
+            args.extend(['-o', 'ControlPath=%s' % self.control_path,
+                         '-o', 'ControlMaster=auto'])
+        args.extend(['-o', 'ConnectTimeout=%d' % CONNECT_TIMEOUT,
+                     '-o', 'BatchMode=yes'])
+        args.extend(self.options)
+        args.append(self.host)
+        return args
+
+    def connect(self):
+        """Start the master connection; one handshake per host."""
+        with self._connect_lock:
+            if self._connected or not self.multiplex:
+                return
+            cmd = ['ssh', '-o', 'ControlPath=%s' % self.control_path,
+                   '-o', 'ControlMaster=yes',
+                   '-o', 'ControlPersist=%d' % CONTROL_PERSIST,
+                   '-o', 'ConnectTimeout=%d' % CONNECT_TIMEOUT,
+                   '-o', 'BatchMode=yes', '-f', '-N']
+            cmd.extend(self.options)
+            cmd.append(self.host)
+            start = time.time()
+            returncode = subprocess.call(cmd)
+            self._record(['<connect>'], start, returncode)
+            # A failed master is not fatal; commands fall back to plain ssh.
+            self._connected = True
+
+    def popen(self, cmd, **kwargs):
+        """Start cmd on the host; the caller owns the returned Popen."""
+        self.connect()
+        return subprocess.Popen(self.ssh_args() + list(cmd), **kwargs)
+
+    def run(self, cmd, input=None, timeout=None, check=True):
+        """Run cmd, returning (returncode, stdout, stderr)."""
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+        cmd = list(cmd)
+        start = time.time()
+        p = self.popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE)
+        timer, expired = None, []
+        if timeout:
+            def _kill():
+                expired.append(True)
+                try:
+                    p.kill()
+                except OSError:
+                    pass
+            timer = threading.Timer(timeout, _kill)
+            timer.start()
+        try:
+            out, err = p.communicate(input)
+        finally:
+            if timer:
+                timer.cancel()
+                timer.join()
+        self._record(cmd, start, p.returncode)
+        if expired:
+            raise SessionTimeout(self.host, cmd, timeout)
+        if check and p.returncode != 0:
+            sys.stderr.write(err)
+            raise subprocess.CalledProcessError(p.returncode, cmd, out)
+        return p.returncode, out, err
+
+    def execute(self, cmd, input=None, timeout=None):
+        """Run cmd and return its stdout; raise on failure or timeout."""
+        return self.run(cmd, input=input, timeout=timeout)[1]
+
+    def stream(self, cmd):
+        """Yield stdout lines of cmd as they arrive; raise on failure."""
+        cmd = list(cmd)
+        start = time.time()
+        p = self.popen(cmd, stdout=subprocess.PIPE)
+        try:
+            for line in p.stdout:
+                yield line.rstrip('\n')
+        finally:
+            p.stdout.close()
+            p.wait()
+            self._record(cmd, start, p.returncode)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+
+    def script(self, text, timeout=None):
+        """Run a multi-line shell script in a single round trip."""
+        return self.execute(['sh', '-s'], input=text, timeout=timeout)
+
+    def close(self):
+        if self._connected:
+            with open(os.devnull, 'w') as null:
+                subprocess.call(['ssh', '-o',
+                                 'ControlPath=%s' % self.control_path,
+                                 '-O', 'exit', self.host],
+                                stdout=null, stderr=null)
+            self._connected = False
+
+    def _record(self, cmd, start, returncode):
+        cmd, elapsed = " ".join(cmd), time.time() - start
+        self.history.append((cmd, elapsed, returncode))
+        totals = self.totals
+        totals[0] += 1
+        totals[1] += elapsed
+        totals[2] = max(totals[2], elapsed)
+        totals[3] += returncode != 0
+        for listener in _listeners:
+            listener(self.host, cmd, start, elapsed, returncode)
+
+
+def add_listener(listener):
+    """Call listener(host, cmd, start, elapsed, returncode) per command."""
+    _listeners.append(listener)
+
+
+def get_session(host, **kwargs):
+    """Return the shared Session for host, creating it on first use."""
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = _sessions[host] = Session(host, **kwargs)
+        return session
+
+
+def close_all():
+    for session in _sessions.values():
+        session.close()
+    if _control_path_dir and os.path.isdir(_control_path_dir):
+        shutil.rmtree(_control_path_dir, ignore_errors=True)
+
+atexit.register(close_all)
+
+
+_range_rx = re.compile(r"\[([^\]]*)\]")
+def expand_hosts(text):
+    """Expand pdsh style host lists: 'cc[1-3,7]-p,v[1,3]-p'.
+
+    Zero padding in a range is kept: 'cc[01-03]' gives cc01, cc02, cc03.
+    """
+    hosts, seen = [], set()
+    # Split on commas outside brackets
+    for pattern in re.findall(r"(?:[^,\[]|\[[^\]]*\])+", text):
+        parts = _range_rx.split(pattern)
+        choices = []
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                choices.append([part])
+                continue
+            values = []
+            for item in part.split(','):
+                if '-' in item:
+                    low, high = item.split('-', 1)
+                    width = len(low) if low.startswith('0') else 0
+                    for n in range(int(low), int(high) + 1):
+                        values.append("%0*d" % (width, n))
+                else:
+                    values.append(item)
+            choices.append(values)
+        for combination in itertools.product(*choices):
+            host = "".join(combination)
+            if host not in seen:
+                seen.add(host)
+                hosts.append(host)
+    return hosts
+
+
+class Collector(object):
+    """Run one command on many hosts, yielding results as hosts finish.
+
+    At most workers hosts run at once, each under its own timeout, so a
+    slow host only holds up its own slot. Hosts that fail are retried,
+    and only those, up to retries more times once the first pass is done.
+    parse is applied to each host's stdout; a parse error counts as a
+    failure. Hosts still failing at the end are left in failed.
+    """
+    def __init__(self, hosts, cmd, input=None, parse=None, workers=32,
+                 timeout=15, retries=1):
+        self.hosts = list(hosts)
+        self.cmd = list(cmd)
+        self.input = input
+        self.parse = parse
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.latency = {}
+        self.attempts = {}
+        self.failed = {}
+
+    def _worker(self, jobs, results):
+        while True:
+            try:
+                host = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            session = get_session(host, multiplex=False)
+            start = time.time()
+            try:
+                out = session.execute(self.cmd, input=self.input,
+                                      timeout=self.timeout)
+                value = self.parse(out) if self.parse else out
+                results.put((host, True, value, time.time() - start))
+            except Exception, e:
+                results.put((host, False, e, time.time() - start))
+
+    def __iter__(self):
+        """Yield (host, parsed stdout) as each host succeeds."""
+        pending = self.hosts
+        for attempt in range(self.retries + 1):
+            if not pending:
+                break
+            if attempt:
+                print >> sys.stderr, "retrying %d hosts" % len(pending)
+            jobs, results = Queue.Queue(), Queue.Queue()
+            for host in pending:
+                jobs.put(host)
+            for i in range(min(self.workers, len(pending))):
+                thread = threading.Thread(target=self._worker,
+                                          args=(jobs, results))
+                thread.daemon = True
+                thread.start()
+            failed = []
+            for i in range(len(pending)):
+                host, ok, value, elapsed = results.get()
+                self.latency[host] = elapsed
+                self.attempts[host] = attempt + 1
+                if ok:
+                    self.failed.pop(host, None)
+                    yield host, value
+                else:
+                    self.failed[host] = value
+                    failed.append(host)
+            pending = failed
+        for host in sorted(self.failed):
+            print >> sys.stderr, "%s: failed: %s" % (host, self.failed[host])
+
+    def run(self):
+        """{host: parsed stdout} for every host that succeeded."""
+        return dict(self)
+
+    def print_stats(self, fh=sys.stderr, slowest=10):
+        """Summary line plus the slowest hosts."""
+        if not self.latency:
+            return
+        times = self.latency.values()
+        print >> fh, "%s: %d hosts, %d failed, mean %.2fs, max %.2fs" % (
+            " ".join(self.cmd), len(times), len(self.failed),
+            sum(times) / len(times), max(times))
+        hosts = sorted(self.latency, key=self.latency.get, reverse=True)
+        for host in hosts[:slowest]:
+            print >> fh, "  %-16s %8.2fs %d attempt(s)%s" % (
+                host, self.latency[host], self.attempts[host],
+                " FAILED" if host in self.failed else "")
+
+
+def print_stats(fh=sys.stderr):
+    """Per-host command count and latency summary."""
+    fmt = "%-12s %6s %10s %10s %10s %6s"
+    print >> fh, fmt % ('host', 'cmds', 'total(s)', 'mean(s)', 'max(s)',
+                        'fails')
+    for host in sorted(_sessions):
+        count, total, longest, fails = _sessions[host].totals
+        if not count:
+            continue
+        print >> fh, fmt % (host, count, "%.2f" % total,
+                            "%.3f" % (total / count), "%.3f" % longest,
+                            fails)
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 import argparse
+import contextlib
+import json
 import os
+import pipes
 import re
-import string
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import Queue
 
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEBase import MIMEBase
@@ -16,7 +21,101 @@ import smtplib
 
 from keystoneclient.v2_0 import client as keystone
 
+import magellan_ssh
+
 MIGRATE_SNAPSHOT_PREFIX = "migrate"
+DB_HOST = 'm3-p'
+COMMAND_TIMEOUT = 300
+# One batch of snapshot destroys can take far longer than other commands
+DESTROY_TIMEOUT = 3600
+_volume_name_rx = re.compile("volume-([0-9a-fA-F]{8})$")
+TRANSFER_CHUNK = 1024 * 1024
+TRANSFER_BUFFER = 256 * 1024 * 1024
+DISK_SAMPLE_INTERVAL = 5
+# Stream digests recorded on each transferred migrate snapshot.
+DIGEST_SENT = 'org.magellan:send-sha256'
+DIGEST_RECEIVED = 'org.magellan:recv-sha256'
+# Pass-through filter run on both ends of a stream: copies stdin to stdout
+# and reports the sha256 and length of what it copied on stderr, followed
+# by its arguments as a label.
+DIGEST_FILTER = ['python', '-c', "'"
+    'import hashlib,sys;h=hashlib.sha256();'
+    'i=getattr(sys.stdin,"buffer",sys.stdin);'
+    'o=getattr(sys.stdout,"buffer",sys.stdout);'
+    'n=sum(h.update(b) or o.write(b) or len(b) '
+    'for b in iter(lambda:i.read(1048576),b""));o.flush();'
+    'sys.stderr.write("sha256 %s %d %s\\n"%(h.hexdigest(),n,'
+    '" ".join(sys.argv[1:])))'
+    "'"]
+# Filter run on the source between zfs send and the ssh to dest. It holds
+# up to SIZE bytes read in CHUNK pieces, so a stall on one side doesn't
+# stop the other, keeps to the rate in bytes/sec found in RATE_FILE (read
+# again every INTERVAL seconds; '-' means unlimited, an unreadable file
+# keeps the last rate) and reports the bytes relayed so far on stderr.
+# Args: CHUNK SIZE INTERVAL RATE_FILE
+RELAY_FILTER = ['python', '-c', "'" + "\n".join([
+    'import sys,threading,time',
+    'try:',
+    ' import Queue as queue',
+    'except ImportError:',
+    ' import queue',
+    'chunk,size=int(sys.argv[1]),int(sys.argv[2])',
+    'interval,path=float(sys.argv[3]),sys.argv[4]',
+    'i=getattr(sys.stdin,"buffer",sys.stdin)',
+    'o=getattr(sys.stdout,"buffer",sys.stdout)',
+    'q=queue.Queue(max(1,size//chunk))',
+    'def read():',
+    ' while True:',
+    '  b=i.read(chunk)',
+    '  q.put(b)',
+    '  if not b:',
+    '   return',
+    'def rate():',
+    ' try:',
+    '  return float(open(path).read())',
+    ' except (IOError,OSError,ValueError):',
+    '  return None',
+    't=threading.Thread(target=read)',
+    't.daemon=True',
+    't.start()',
+    'r=rate() or 0',
+    'sent=base=0',
+    'start=last=time.time()',
+    'try:',
+    ' while True:',
+    '  b=q.get()',
+    '  if not b:',
+    '   break',
+    '  o.write(b)',
+    '  sent+=len(b)',
+    '  now=time.time()',
+    '  if r and (sent-base)/r>now-start:',
+    '   time.sleep((sent-base)/r-(now-start))',
+    '  if now-last>=interval:',
+    '   last=now',
+    '   sys.stderr.write("relayed %d\\n"%sent)',
+    '   sys.stderr.flush()',
+    '   n=rate()',
+    '   if n is not None and n!=r:',
+    '    r,base,start=n,sent,now',
+    ' o.flush()',
+    'except (IOError,OSError):',
+    ' sys.exit(1)',
+    'sys.stderr.write("relayed %d\\n"%sent)']) + "'"]
+# Written to stderr by the source pipeline as each leg exits
+TRANSFER_STATUS = 'migrate-status'
+# Completed transfers, one JSON object per line; plan reads rates from it
+TRANSFER_LOG = os.path.expanduser('~/.migrate-volume-transfers')
+# On-the-wire compression: (source filter, destination filter)
+COMPRESSORS = {'gzip': (['gzip', '-1'], ['gzip', '-dc']),
+               'lz4': (['lz4', '-c'], ['lz4', '-dc'])}
+_migrate_snapshot_rx = re.compile("^(.*)@%s_(\d+)$" % MIGRATE_SNAPSHOT_PREFIX)
+
+def _migrate_number(snapshot):
+    """Number of a 'migrate_N' snapshot name (with or without dataset)."""
+    m = re.match("^%s_(\d+)$" % MIGRATE_SNAPSHOT_PREFIX,
+                 snapshot.split('@')[-1])
+    return int(m.group(1)) if m else None
 
 def _add_arg(f, *args, **kwargs):
     """Bind CLI arguments to a shell.py `do_foo` function."""
@@ -123,6 +222,235 @@ def _tbl_text(text, delimiter="\t"):
         final.append(dict(zip(headers, cols)))
     return final
 
+_size_rx = re.compile("^(\d+(?:\.\d+)?)([kmgt]?)b?$", re.I)
+def _parse_size(text):
+    """Parse '512', '10M', '1.5G' (powers of 1024) into bytes."""
+    m = _size_rx.match(text.strip())
+    if not m:
+        raise argparse.ArgumentTypeError("Invalid size: %s" % text)
+    number, unit = m.groups()
+    return int(float(number) * 1024 ** ' kmgt'.index(unit.lower() or ' '))
+
+def _parse_digest(text, label):
+    """(hexdigest, length) from DIGEST_FILTER's stderr, or None."""
+    digest = None
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) == 4 and parts[0] == 'sha256' and parts[3] == label:
+            digest = (parts[1], int(parts[2]))
+    return digest
+
+def _describe(text):
+    """text with the inline filter programs abbreviated."""
+    return text.replace(" ".join(DIGEST_FILTER), '<sha256>').replace(
+        " ".join(RELAY_FILTER), '<relay>')
+
+def _pipeline(stages):
+    """Shell pipeline from a list of argv stages."""
+    return " | ".join(" ".join(stage) for stage in stages)
+
+def _positive_int(text):
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected a number, got %s" % text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("Must be at least 1: %s" % text)
+    return value
+
+def _parse_rate_range(text):
+    """Parse 'MIN:MAX' rates, e.g. '10M:200M'."""
+    try:
+        low, high = text.split(':')
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected MIN:MAX, got %s" % text)
+    low, high = _parse_size(low), _parse_size(high)
+    if not 0 < low <= high:
+        raise argparse.ArgumentTypeError("Invalid rate range: %s" % text)
+    return (low, high)
+
+def _format_size(size):
+    for unit in ['B', 'K', 'M', 'G']:
+        if abs(size) < 1024:
+            return "%.1f%s" % (size, unit)
+        size /= 1024.0
+    return "%.1fT" % size
+
+_transfer_log_lock = threading.Lock()
+def _record_transfer(record):
+    with _transfer_log_lock:
+        try:
+            with open(TRANSFER_LOG, 'a') as fh:
+                fh.write(json.dumps(record) + "\n")
+        except IOError, e:
+            print >>sys.stderr, "Unable to record transfer: %s" % e
+
+def _measured_rate(source, dest, samples=20):
+    """Bytes/sec over the last transfers from source to dest, or None."""
+    if not os.path.exists(TRANSFER_LOG):
+        return None
+    with open(TRANSFER_LOG, 'r') as fh:
+        records = [json.loads(line) for line in fh if line.strip()]
+    pair = [r for r in records
+            if r['source'] == source.host and r['dest'] == dest.host]
+    # Fall back to every route we've measured before giving up.
+    records = (pair if pair else records)[-samples:]
+    seconds = sum(r['seconds'] for r in records)
+    if not seconds:
+        return None
+    return sum(r['bytes'] for r in records) / seconds
+
+def _parallel(servers, fn):
+    """Call fn(server) for every server at once; {host: result}."""
+    results, errors = {}, {}
+    def call(server):
+        try:
+            results[server.host] = fn(server)
+        except Exception, e:
+            errors[server.host] = e
+    threads = [threading.Thread(target=call, args=(s,)) for s in servers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for host, e in errors.iteritems():
+        raise Exception("%s: %s" % (host, e))
+    return results
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+    return "%dm%02ds" % (seconds // 60, seconds % 60)
+
+class Tracer(object):
+    """Write timed phase events to a JSON-lines file.
+
+    Each event carries the phase name, start and end time, the host and
+    volume it concerns, bytes moved, exit code and the id of the
+    enclosing phase, so one file can hold many migrations and still be
+    broken down with the report command. Every remote command run
+    through magellan_ssh is recorded as an 'ssh' event. Without a path
+    nothing is written.
+    """
+    def __init__(self):
+        self.fh = None
+        self.run = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_id = 0
+
+    def open(self, path, argv=()):
+        self.fh = open(path, 'a')
+        self.run = "%s-%d" % (int(time.time()), os.getpid())
+        magellan_ssh.add_listener(self._ssh_event)
+        self._write({'phase': 'command', 'argv': list(argv),
+                     'start': time.time(), 'seconds': 0})
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _write(self, event):
+        event['run'] = self.run
+        with self._lock:
+            self.fh.write(json.dumps(event) + "\n")
+            self.fh.flush()
+
+    @contextlib.contextmanager
+    def span(self, phase, **fields):
+        """Time the enclosed block; the yielded dict takes extra fields."""
+        if not self.fh:
+            yield fields
+            return
+        with self._lock:
+            self._next_id += 1
+            event_id = self._next_id
+        stack = self._stack()
+        event = dict(fields, phase=phase, id=event_id,
+                     parent=stack[-1] if stack else None)
+        stack.append(event_id)
+        start = time.time()
+        try:
+            yield event
+        except Exception, e:
+            event['error'] = str(e)
+            raise
+        finally:
+            stack.pop()
+            event['start'] = start
+            event['seconds'] = time.time() - start
+            self._write(event)
+
+    def _ssh_event(self, host, cmd, start, elapsed, returncode):
+        stack = self._stack()
+        self._write({'phase': 'ssh', 'host': host, 'cmd': cmd,
+                     'start': start, 'seconds': elapsed,
+                     'returncode': returncode,
+                     'parent': stack[-1] if stack else None})
+
+_tracer = Tracer()
+trace = _tracer.span
+
+class TraceReport(object):
+    """Where the time went across the events in trace files."""
+    def __init__(self, group_by=None):
+        self.group_by = group_by
+        self.rows = {}
+        self.runs = set()
+
+    def load(self, path):
+        with open(path) as fh:
+            for line in fh:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                self.add(event)
+
+    def add(self, event):
+        if event.get('phase') == 'command':
+            self.runs.add(event.get('run'))
+            return
+        key = (event.get('phase'),)
+        if self.group_by:
+            key += (event.get(self.group_by),)
+        row = self.rows.setdefault(key, {'count': 0, 'seconds': 0.0,
+                                         'max': 0.0, 'bytes': 0,
+                                         'errors': 0})
+        seconds = event.get('seconds', 0)
+        row['count'] += 1
+        row['seconds'] += seconds
+        row['max'] = max(row['max'], seconds)
+        row['bytes'] += event.get('bytes') or 0
+        if event.get('error') or event.get('returncode'):
+            row['errors'] += 1
+
+    def print_table(self):
+        fmt = "%-16s %6s %10s %9s %9s %10s %10s %6s"
+        header = ['phase', 'count', 'total', 'mean', 'max', 'bytes', 'rate',
+                  'errors']
+        if self.group_by:
+            fmt = "%-16s " + fmt
+            header.insert(1, self.group_by)
+        print "%d runs" % len(self.runs)
+        print fmt % tuple(header)
+        rows = sorted(self.rows.items(), key=lambda r: -r[1]['seconds'])
+        for key, row in rows:
+            rate = ''
+            if row['bytes'] and row['seconds']:
+                rate = "%s/s" % _format_size(row['bytes'] / row['seconds'])
+            values = [key[0]]
+            if self.group_by:
+                values.append(key[1] if key[1] is not None else '-')
+            values.extend([row['count'], "%.1fs" % row['seconds'],
+                           "%.2fs" % (row['seconds'] / row['count']),
+                           "%.2fs" % row['max'],
+                           _format_size(row['bytes']) if row['bytes'] else '',
+                           rate, row['errors']])
+            print fmt % tuple(values)
+
 def get_keystone_client(tenant=None):
     def _get_os_env(tenant=None):
         try:
@@ -143,6 +471,138 @@ def get_keystone_client(tenant=None):
         username=username, password=password,
         tenant_name=tenant, auth_url=auth_url)
 
+class VolumeDB(object):
+    """Volume rows from the DB host, fetched in bulk and cached briefly.
+
+    Each call runs the m3-p helper scripts for every requested volume in
+    one remote script, so N volumes cost one round trip instead of N.
+    """
+    def __init__(self, host=DB_HOST, ttl=60):
+        self.host = host
+        self.ttl = ttl
+        self._rows = {}     # volume id -> (fetched at, row)
+        self._lock = threading.Lock()
+
+    def _script(self, lines):
+        session = magellan_ssh.get_session(self.host)
+        return session.script("\n".join(lines) + "\n")
+
+    def get_many(self, ids, strict=True):
+        """Rows for ids, fetching only the missing or expired ones.
+
+        Unless strict, ids with no row are left out instead of raising.
+        """
+        ids = [int(i) for i in ids]
+        now = time.time()
+        with self._lock:
+            stale = [i for i in ids if i not in self._rows or
+                     now - self._rows[i][0] > self.ttl]
+        if stale:
+            lines = []
+            for volume_id in sorted(set(stale)):
+                lines.append("echo '@@ %d'" % volume_id)
+                lines.append("./get_volume %d" % volume_id)
+            fetched = {}
+            volume_id, text = None, []
+            for line in self._script(lines).splitlines() + ['@@ end']:
+                if line.startswith('@@ '):
+                    if volume_id is not None:
+                        rows = _tbl_text("\n".join(text))
+                        if rows:
+                            fetched[volume_id] = rows[0]
+                    volume_id, text = line[3:], []
+                else:
+                    text.append(line)
+            with self._lock:
+                for volume_id, row in fetched.iteritems():
+                    self._rows[int(volume_id)] = (now, row)
+        rows = {}
+        for volume_id in ids:
+            if volume_id not in self._rows:
+                if not strict:
+                    continue
+                raise Exception("Unknown volume %d." % volume_id)
+            rows[volume_id] = self._rows[volume_id][1]
+        return rows
+
+    def get(self, id):
+        return self.get_many([id])[int(id)]
+
+    def _update(self, volume_id, **values):
+        with self._lock:
+            if volume_id in self._rows:
+                self._rows[volume_id][1].update(values)
+
+    def _run_each(self, commands):
+        """Run [(volume id, command)] in one script; (ids done, stderr).
+
+        Each command echoes a marker when it succeeds, since the
+        script's exit status is only the last one's.
+        """
+        lines = ["%s && echo '@@ ok %d'" % (cmd, int(i))
+                 for i, cmd in commands]
+        session = magellan_ssh.get_session(self.host)
+        returncode, out, err = session.run(
+            ['sh', '-s'], input="\n".join(lines) + "\n", check=False)
+        done = set(int(line.split()[2]) for line in out.splitlines()
+                   if line.startswith('@@ ok '))
+        return done, err
+
+    def _check(self, ids, done, err):
+        failed = sorted(set(int(i) for i in ids) - done)
+        if failed:
+            raise Exception("DB update failed for volumes %s: %s" % (
+                ", ".join(map(str, failed)), err.strip()))
+
+    def set_state(self, state, ids):
+        """Reset the status of many volumes in one round trip."""
+        done, err = self._run_each([(i, "./reset_volume_state %s %d" % (
+            state, int(i))) for i in ids])
+        for volume_id in done:
+            self._update(volume_id, status=state)
+        self._check(ids, done, err)
+
+    def set_hosts(self, moves):
+        """Point volumes at new hosts; moves is [(id, host, iqn)]."""
+        done, err = self._run_each([(i, './volume_migrate %d %s "%s"' % (
+            int(i), host, iqn)) for i, host, iqn in moves])
+        for volume_id, host, iqn in moves:
+            if int(volume_id) in done:
+                self._update(int(volume_id), host=host)
+        self._check([m[0] for m in moves], done, err)
+
+_volume_db = VolumeDB()
+
+def load_volumes(ids, db=None):
+    """Volume objects for ids with one bulk DB fetch."""
+    db = db if db else _volume_db
+    db.get_many(ids)
+    return [Volume(i, db=db) for i in ids]
+
+def update_db_hosts(volumes, dest):
+    """Record dest as the primary of volumes in one DB round trip."""
+    if not volumes:
+        return
+    moves = [(v.id, dest.service_host, dest.volume_iqn(v)) for v in volumes]
+    with trace('db_update', host=DB_HOST, volumes=[v.id for v in volumes]):
+        volumes[0].db.set_hosts(moves)
+    for volume in volumes:
+        volume.host = dest.service_host
+
+def lock_volumes(volumes):
+    if volumes:
+        with trace('lock', host=DB_HOST, volumes=[v.id for v in volumes]):
+            volumes[0].db.set_state('deleted', [v.id for v in volumes])
+    for volume in volumes:
+        volume.db_status = 'deleted'
+
+def unlock_volumes(volumes):
+    if volumes:
+        with trace('unlock', host=DB_HOST, volumes=[v.id for v in volumes]):
+            volumes[0].db.set_state('detached', [v.id for v in volumes])
+    for volume in volumes:
+        volume.db_status = 'detached'
+
 class VolumeServerContainer(object):
     """Need this container for VolumeServer objects for get_server behavior."""
     def __init__(self, servers=[]):
@@ -157,7 +617,7 @@ class VolumeServerContainer(object):
                 return server
             elif server.migrate_iface == hostname:
                 return server
-        Exception("Unknown server %s." % hostname)
+        raise Exception("Unknown server %s." % hostname)
     
     def all(self):
         return self.servers
@@ -169,6 +629,23 @@ class VolumeServer(object):
         self.pool = pool
         self.service_host = service_host if service_host else host
         self.migrate_iface = migrate_iface if migrate_iface else host
+        # dataset -> set of migrate snapshot numbers, filled on demand
+        self._snapshot_index = {}
+        self._pool_indexed = False
+        self._index_lock = threading.Lock()
+        self._export_state = None
+        self._export_lock = threading.Lock()
+        self._busy_sample = (0, 0)
+        self._busy_lock = threading.Lock()
+
+    @property
+    def session(self):
+        return magellan_ssh.get_session(self.host)
+
+    @property
+    def migrate_session(self):
+        """Session on the migration interface, used for zfs recv."""
+        return magellan_ssh.get_session(self.migrate_iface)
 
     def volume_iqn(self, volume):
         ip = self._get_ip_address(self.migrate_iface)
@@ -183,28 +660,136 @@ class VolumeServer(object):
         (ip, host) = p2.communicate()[0].split()
         return ip 
 
+    def disk_busy(self, interval=DISK_SAMPLE_INTERVAL):
+        """%b of the busiest disk over the last interval.
+
+        Concurrent transfers share one sample per interval.
+        """
+        with self._busy_lock:
+            sampled, busy = self._busy_sample
+            if time.time() - sampled < interval:
+                return busy
+            out = self._execute(['iostat', '-xn', str(interval), '2'],
+                                timeout=interval * 2 + COMMAND_TIMEOUT)
+            # Keep the second report; the first covers time since boot.
+            report = out.split('device')[-1]
+            busy = 0
+            for line in report.splitlines():
+                cols = line.split()
+                if len(cols) == 11 and cols[9].isdigit():
+                    busy = max(busy, int(cols[9]))
+            self._busy_sample = (time.time(), busy)
+            return busy
+
     def volume_pool_name(self, volume):
         vol_name = "volume-%08x" % (volume.id)
         return "%s%s" % (self.pool, vol_name) 
 
+    def _pool_dataset(self):
+        return self.pool.rstrip('/')
+
+    def volume_ids(self):
+        """IDs of every volume zvol in the pool."""
+        return sorted(self.volume_usage())
+
+    def volume_usage(self):
+        """{volume id: bytes used} for every volume zvol in the pool."""
+        out = self._execute(['zfs', 'list', '-H', '-p', '-o', 'name,used',
+                             '-t', 'volume', '-d', '1', self._pool_dataset()])
+        usage = {}
+        for line in out.splitlines():
+            name, used = line.split('\t')
+            m = _volume_name_rx.search(name)
+            if m:
+                usage[int(m.group(1), 16)] = int(used)
+        return usage
+
+    def pool_stats(self, interval=5):
+        """Pool capacity, compression and I/O over one iostat interval."""
+        pool = self._pool_dataset()
+        props = self.get_properties([pool], ['available', 'used',
+                                             'compressratio'])
+        stats = {'available': int(props[(pool, 'available')]),
+                 'used': int(props[(pool, 'used')]),
+                 'compressratio': props[(pool, 'compressratio')]}
+        # The second report covers the interval; the first is since boot.
+        out = self._execute(['zpool', 'iostat', pool.split('/')[0],
+                             str(interval), '2'],
+                            timeout=interval * 2 + COMMAND_TIMEOUT)
+        rows = [l.split() for l in out.splitlines() if l.startswith(pool)]
+        read_ops, write_ops, read_bw, write_bw = rows[-1][3:7]
+        stats['ops'] = _parse_size(read_ops) + _parse_size(write_ops)
+        stats['bandwidth'] = _parse_size(read_bw) + _parse_size(write_bw)
+        return stats
+
+    def _list_snapshots(self, dataset, recursive=False, properties=()):
+        """Names of snapshots under dataset; [] if the dataset is missing.
+
+        With properties, each entry is instead a [name, value, ...] row.
+        """
+        columns = ",".join(['name'] + list(properties))
+        cmd = ['zfs', 'list', '-H', '-p', '-o', columns, '-t', 'snapshot']
+        if recursive:
+            cmd.extend(['-r', dataset])
+        else:
+            cmd.extend(['-d', '1', dataset])
+        with trace('list_snapshots', host=self.host, dataset=dataset):
+            returncode, out, err = self.session.run(cmd, check=False)
+        if returncode != 0:
+            if 'does not exist' in err:
+                return []
+            sys.stderr.write(err)
+            raise subprocess.CalledProcessError(returncode, cmd, out)
+        if properties:
+            return [line.split('\t') for line in out.splitlines() if line]
+        return out.split()
+
+    def _index_snapshots(self, names, datasets=()):
+        """Fold snapshot names into the index; datasets start out empty."""
+        with self._index_lock:
+            for dataset in datasets:
+                self._snapshot_index[dataset] = set()
+            for name in names:
+                m = _migrate_snapshot_rx.match(name)
+                if not m:
+                    continue
+                dataset, count = m.groups()
+                self._snapshot_index.setdefault(dataset, set()).add(int(count))
+
+    def load_snapshot_index(self, properties=()):
+        """Index the migrate snapshots of the whole pool in one listing.
+
+        Returns {snapshot name: {property: value}} for the migrate
+        snapshots when extra properties are asked for.
+        """
+        rows = self._list_snapshots(self._pool_dataset(), recursive=True,
+                                    properties=properties)
+        if not properties:
+            rows = [[name] for name in rows]
+        rows = [r for r in rows if _migrate_snapshot_rx.match(r[0])]
+        with self._index_lock:
+            self._snapshot_index = {}
+            self._pool_indexed = True
+        self._index_snapshots([r[0] for r in rows])
+        return dict((r[0], dict(zip(properties, r[1:]))) for r in rows)
+
+    def snapshot_numbers(self, volume):
+        """Sorted migrate snapshot numbers for volume, listed at most once."""
+        vol_name = self.volume_pool_name(volume)
+        if vol_name not in self._snapshot_index and not self._pool_indexed:
+            names = self._list_snapshots(vol_name)
+            self._index_snapshots(names, datasets=[vol_name])
+        return sorted(self._snapshot_index.get(vol_name, ()))
+
     def volume_migrate_snapshots(self, volume):
         """Return list of dictionaries containing volume info."""
-        cmd = ['ssh', self.host, 'zfs', 'list', '-t', 'snapshot']
-        vols = _tbl_text(subprocess.check_output(cmd), delimiter=None)
-        vol_name = self.volume_pool_name(volume)
-        vol_regex = re.compile("^%s@%s" % (vol_name, MIGRATE_SNAPSHOT_PREFIX))
-        return [ v for v in vols if vol_regex.match(v.get('NAME', "")) ]
-    
+        return [ {'NAME': self._volume_snapshot_name(volume, count)}
+                 for count in self.snapshot_numbers(volume) ]
+
     def max_snapshot_number(self, volume):
         """Note that our snapshots start at 1, so 0 implies no snapshots"""
-        snapshots = self.volume_migrate_snapshots(volume) 
-        max_count = 0
-        for snap in snapshots:
-            snap = snap['NAME']
-            parts = snap.split('_')
-            count = parts[len(parts)-1]
-            max_count = max(int(count), max_count)
-        return max_count
+        numbers = self.snapshot_numbers(volume)
+        return numbers[-1] if numbers else 0
 
     def _volume_snapshot_name(self, volume, count):
         vol_name = self.volume_pool_name(volume)
@@ -220,43 +805,128 @@ class VolumeServer(object):
 
     def snapshot(self, volume):
         snapshot_name = self._unique_volume_snapshot_name(volume)
-        cmd = ['ssh', self.host, 'zfs', 'snapshot', snapshot_name]
-        print " ".join(cmd)
-        subprocess.check_output(cmd)
+        cmd = ['zfs', 'snapshot', snapshot_name]
+        print self.host, " ".join(cmd)
+        with trace('snapshot', host=self.host, volume=volume.id):
+            self._execute(cmd)
+        self._index_snapshots([snapshot_name])
         return snapshot_name
 
-    def _send_snapshot(self, dest, volume, snapshot_name, increment=None):
-        """Command line logic for sending snapshots."""
-        cmd = ['ssh', self.host, 'zfs', 'send' ]
+    def send_command(self, snapshot_name, increment=None, token=None):
+        """zfs send argv for a full, incremental or resumed stream."""
+        if token:
+            return ['zfs', 'send', '-t', token]
+        cmd = ['zfs', 'send']
         if increment:
             cmd.extend(['-i', increment])
-        dest_volume_name = dest.volume_pool_name(volume)
-        cmd.extend([snapshot_name, "|", 'ssh', dest.migrate_iface, 'zfs',
-                    'recv', dest_volume_name])
-        print " ".join(cmd)
-        subprocess.check_call(cmd)
-
-    def send_snapshot(self, dest, volume, snapshot_name):
-        """Send snapshot to dest, trying to do incremental transfer."""
-        ours = self.max_snapshot_number(volume)
-        theirs = dest.max_snapshot_number(volume)
-        inc = min(ours, theirs)
-        # Zero implies no snapshots on one side or the other
-        if inc != 0:
-            self._send_snapshot(dest, volume, snapshot_name, increment=inc)
-        self._send_snapshot(dest, volume, snapshot_name)
+        cmd.append(snapshot_name)
+        return cmd
+
+    def estimate_send_size(self, snapshot_name, increment=None, token=None):
+        """Stream size in bytes from a dry-run 'zfs send -nvP'."""
+        cmd = self.send_command(snapshot_name, increment, token)
+        cmd[2:2] = ['-n', '-v', '-P']
+        returncode, out, err = self.session.run(cmd)
+        for line in (out + err).splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[0] == 'size':
+                return int(parts[1])
+        return None
+
+    def receive_resume_token(self, volume):
+        """Token left by an interrupted 'zfs recv -s', or None."""
+        cmd = ['zfs', 'get', '-H', '-o', 'value', 'receive_resume_token',
+               self.volume_pool_name(volume)]
+        returncode, out, err = self.session.run(cmd, check=False)
+        token = out.strip()
+        if returncode != 0 or token in ('', '-'):
+            return None
+        return token
+
+    def get_properties(self, datasets, properties):
+        """{(dataset, property): value} from one 'zfs get'."""
+        out = self._execute(['zfs', 'get', '-H', '-p', '-o',
+                             'name,property,value', ",".join(properties)] +
+                            list(datasets))
+        values = {}
+        for line in out.splitlines():
+            parts = line.split('\t')
+            if len(parts) == 3:
+                values[(parts[0], parts[1])] = parts[2]
+        return values
+
+    def set_properties(self, snapshot_name, properties):
+        """Set user properties on snapshot_name in one round trip."""
+        self.session.script("".join(
+            "zfs set %s=%s %s\n" % (prop, value, snapshot_name)
+            for prop, value in sorted(properties.items())))
+
+    def written_since(self, snapshot_name):
+        """Bytes written to the dataset after snapshot_name was taken."""
+        dataset, snapshot = snapshot_name.split('@', 1)
+        out = self._execute(['zfs', 'get', '-H', '-p', '-o', 'value',
+                             'written@%s' % snapshot, dataset])
+        return int(out.strip())
+
+    def refresh_snapshots(self, volume):
+        """Re-list volume's snapshots after an unpredictable change."""
+        vol_name = self.volume_pool_name(volume)
+        self._index_snapshots(self._list_snapshots(vol_name),
+                              datasets=[vol_name])
+
+    def common_snapshot_number(self, dest, volume):
+        """Newest migrate snapshot present on both sides; 0 if none."""
+        common = set(self.snapshot_numbers(volume))
+        common.intersection_update(dest.snapshot_numbers(volume))
+        return max(common) if common else 0
+
+    def send_snapshot(self, dest, volume, snapshot_name, **transfer):
+        """Send snapshot to dest, trying to do incremental transfer.
+
+        Returns the number of bytes that crossed the wire.
+        """
+        if _migrate_number(snapshot_name) in dest.snapshot_numbers(volume):
+            return 0
+        with trace('send', host=self.host, dest=dest.host,
+                   volume=volume.id, snapshot=snapshot_name) as event:
+            event['bytes'] = SnapshotTransfer(self, dest, volume,
+                                              snapshot_name,
+                                              **transfer).run()
+        return event['bytes']
 
     def destroy(self, pool_spec):
         """Issue a destroy against a poolname."""
-        cmd = ['ssh', self.host, 'zfs', 'destroy', pool_spec]
-        print " ".join(cmd)
-        subprocess.check_call(cmd)
+        cmd = ['zfs', 'destroy', pool_spec]
+        print self.host, " ".join(cmd)
+        self._execute(cmd)
+        self._unindex_snapshots(pool_spec)
+
+    def _unindex_snapshots(self, pool_spec):
+        """Drop destroyed snapshots ('vol@a,b' or 'vol@a%b') from the index."""
+        if '@' not in pool_spec:
+            with self._index_lock:
+                self._snapshot_index.pop(pool_spec, None)
+            return
+        dataset, spec = pool_spec.split('@', 1)
+        with self._index_lock:
+            numbers = self._snapshot_index.get(dataset)
+            if numbers is None:
+                return
+            for part in spec.split(','):
+                if '%' in part:
+                    first, last = part.split('%', 1)
+                    first = _migrate_number(first) or min(numbers or [0])
+                    last = _migrate_number(last) or max(numbers or [0])
+                    numbers.difference_update(range(first, last + 1))
+                else:
+                    numbers.discard(_migrate_number(part))
 
     # Functions from nova.volume.san below
-    def _execute(self, *cmd):
-        command = ['ssh', self.host]
-        command.extend(*cmd)
-        return subprocess.check_output(command)
+    def _execute(self, *cmd, **kwargs):
+        # Callers pass either a single argv list or the argv items.
+        if len(cmd) == 1 and isinstance(cmd[0], list):
+            cmd = cmd[0]
+        return self.session.execute(cmd, **kwargs)
     
     def _build_volume_name(self, volume_id):
         return "volume-%08x" % volume_id
@@ -268,213 +938,339 @@ class VolumeServer(object):
         pool = self._build_zfs_poolname(volume_id)
         return '/dev/zvol/rdsk/%s' % pool
         
-    def _get_luid(self, volume_id):
-        zvol_name = self._build_zvol_name(volume_id)
-        out = self._execute('/usr/sbin/sbdadm', 'list-lu')
-        lines = [ line.strip() for line in out.splitlines() ]
-        # Strip headers
-        if len(lines) >= 1:
-            if lines[0] == '':
-                lines = lines[1:]
-        if len(lines) >= 4:
-            assert 'Found' in lines[0]
-            assert '' == lines[1]
-            assert 'GUID' in lines[2]
-            assert '------------------' in lines[3]
-            lines = lines[4:]
-        for line in lines:
-            items = line.split()
-            assert len(items) == 3
-            if items[2] == zvol_name:
-                luid = items[0].strip()
-                return luid
-        
-    def _is_lu_created(self, volume_id):
-        return self._get_luid(volume_id)
-
     def _build_iscsi_target_name(self, volume_id):
         name = self._build_volume_name(volume_id)
         return "%s%s" % ("iqn.2010-10.org.openstack:", name)
 
-    def _get_prefixed_values(self, data, prefix):
-        """Collect lines which start with prefix; with trimming"""
-        matches = []
-        for line in data.splitlines():
-            line = line.strip()
-            if line.startswith(prefix):
-                match = line[len(prefix):]
-                match = match.strip()
-                matches.append(match)
-        return matches
-
-    def _get_target_groups(self):
-        out = self._execute('/usr/sbin/stmfadm', 'list-tg')
-        return self._get_prefixed_values(out, 'Target group: ')    
-
-    def _target_group_exists(self, target_group_name):
-        return target_group_name not in self._get_target_groups()
-
-    def _get_target_group_members(self, tg_name):
-        out = self._execute('/usr/sbin/stmfadm', 'list-tg', '-v', tg_name)
-        return self._get_prefixed_values(out, 'Member: ')
-
-    def _is_target_group_member(self, target_group_name, iscsi_target_name):
-        members =  self._get_target_group_members(target_group_name)
-        return iscsi_target_name in members
-
-    def _get_iscsi_targets(self):
-        out = self._execute('/usr/sbin/itadm', 'list-target')
-        matches = [ line.strip() for line in out.splitlines() ]
-        # Skip header
-        if len(matches) != 0:
-            assert 'TARGET NAME' in matches[0]
-            matches = matches[1:]
-        targets = []
-        for line in matches:
-            items = line.split()
-            assert len(items) == 3
-            targets.append(items[0])
-        return targets
+    def export_state(self, refresh=False):
+        """COMSTAR state, fetched once and reused until exports change."""
+        if refresh or self._export_state is None:
+            out = self.session.script(_EXPORT_STATE_SCRIPT)
+            self._export_state = ExportState(out)
+        return self._export_state
+
+    def _apply_export_commands(self, lines):
+        """Run the computed COMSTAR changes as one remote script."""
+        if not lines:
+            return
+        for line in lines:
+            print self.host, line
+        self._export_state = None
+        self.session.script("set -e\n%s\n" % "\n".join(lines))
 
-    def _iscsi_target_exists(self, iscsi_target_name):
-        return iscsi_target_name in self._get_iscsi_targets()
+    def create_exports(self, volumes):
+        """Creates exports for logical volumes."""
+        with trace('create_exports', host=self.host,
+                   volumes=[v.id for v in volumes]), self._export_lock:
+            state = self.export_state()
+            lines = []
+            for volume in volumes:
+                lines.extend(state.export_commands(self, volume.id))
+            self._apply_export_commands(lines)
 
-    def _view_exists(self, luid):
-        out = self._execute('/usr/sbin/stmfadm', 'list-view', '-l', luid)
-        if "no views found" in out:
-            return False
-        if "View Entry:" in out:
-            return True
+    def remove_exports(self, volumes):
+        """Removes exports for logical volumes."""
+        with trace('remove_exports', host=self.host,
+                   volumes=[v.id for v in volumes]), self._export_lock:
+            state = self.export_state()
+            lines = []
+            for volume in volumes:
+                lines.extend(state.unexport_commands(self, volume.id))
+            self._apply_export_commands(lines)
 
     def create_export(self, volume):
         """Creates an export for a logical volume."""
-        zvol_name = self._build_zvol_name(volume.id)
-        if not self._is_lu_created(volume.id):
-           self._execute(['/usr/sbin/sbdadm', 'create-lu', zvol_name]) 
-        luid = self._get_luid(volume.id)
-        iscsi = self._build_iscsi_target_name(volume.id)
-        volume_name = self._build_volume_name(volume.id)
-        tg_name = 'tg-%s' % volume_name
-        if not self._target_group_exists(tg_name):
-            self._execute(['/usr/sbin/stmfadm', 'create-tg', tg_name])
-        if not _is_target_group_member(tg_name, iscsi):
-            self._execute('/usr/sbin/stmfadm', 'add-tg-member', '-g', tg_name,
-                          iscsi)
-        if not self._iscsi_target_exists(iscsi):
-            self._execute('/usr/sbin/itadm', 'create-target', '-n', iscsi) 
-        if not _view_exists(luid):
-            self._execute('/usr/sbin/stmfadm', 'add-view', '-t', tg_name, luid)
+        self.create_exports([volume])
 
     def remove_export(self, volume):
         """Removes an export for a logical volume."""
-        luid = self._get_luid(volume.id)
-        iscsi = self._build_iscsi_target_name(volume.id)
-        volume_name = self._build_volume_name(volume.id)
-        tg_name = 'tg-%s' % volume_name
-        if self._view_exists(luid):
-            self._execute('/usr/sbin/stmfadm', 'remove-view', '-l', luid, '-a')
-        if self._iscsi_target_exists(iscsi):
-            self._execute('/usr/sbin/stmfadm', 'offline-target', iscsi)
-            self._execute('/usr/sbin/itadm', 'delete-target', iscsi)
+        self.remove_exports([volume])
+
+# Gather every LU, target group, target and view in one round trip.
+_EXPORT_STATE_SCRIPT = """\
+echo '@@ list-lu'
+/usr/sbin/sbdadm list-lu
+echo '@@ list-tg'
+/usr/sbin/stmfadm list-tg -v
+echo '@@ list-target'
+/usr/sbin/itadm list-target
+for lu in `/usr/sbin/sbdadm list-lu | awk 'NF == 3 && $3 ~ /^\\// {print $1}'`
+do
+    echo "@@ list-view $lu"
+    /usr/sbin/stmfadm list-view -l $lu 2>&1
+done
+"""
+
+class ExportState(object):
+    """Indexed view of a server's COMSTAR exports.
+
+    Parsed from the output of _EXPORT_STATE_SCRIPT; export_commands and
+    unexport_commands diff a volume against it and return only the shell
+    commands that are still needed.
+    """
+    def __init__(self, text):
+        self.lus = {}               # zvol path -> LU GUID
+        self.target_groups = {}     # target group -> set of members
+        self.targets = set()        # iSCSI target names
+        self.views = set()          # LU GUIDs with at least one view
+        sections = {'list-lu': [], 'list-tg': [], 'list-target': []}
+        current = None
+        for line in text.splitlines():
+            if line.startswith('@@ '):
+                parts = line.split()
+                current = sections.setdefault(" ".join(parts[1:]), [])
+            elif current is not None:
+                current.append(line.strip())
+        self._parse_lus(sections['list-lu'])
+        self._parse_target_groups(sections['list-tg'])
+        self._parse_targets(sections['list-target'])
+        for name, lines in sections.iteritems():
+            if name.startswith('list-view '):
+                if [l for l in lines if "View Entry:" in l]:
+                    self.views.add(name.split()[1])
+
+    def _parse_lus(self, lines):
+        for line in lines:
+            items = line.split()
+            if len(items) == 3 and items[2].startswith('/'):
+                self.lus[items[2]] = items[0]
+
+    def _parse_target_groups(self, lines):
+        group = None
+        for line in lines:
+            if line.lower().startswith('target group: '):
+                group = line[len('target group: '):].strip()
+                self.target_groups[group] = set()
+            elif line.startswith('Member: ') and group is not None:
+                self.target_groups[group].add(line[len('Member: '):].strip())
+
+    def _parse_targets(self, lines):
+        for line in lines:
+            items = line.split()
+            if len(items) == 3 and 'TARGET NAME' not in line:
+                self.targets.add(items[0])
+
+    def export_commands(self, server, volume_id):
+        zvol_name = server._build_zvol_name(volume_id)
+        iscsi = server._build_iscsi_target_name(volume_id)
+        tg_name = 'tg-%s' % server._build_volume_name(volume_id)
+        lines = []
+        luid = self.lus.get(zvol_name)
+        if luid is None:
+            var = 'lu_%d' % volume_id
+            lines.append("%s=`/usr/sbin/sbdadm create-lu %s | "
+                         "awk '$3 == \"%s\" {print $1}'`" % (
+                         var, zvol_name, zvol_name))
+            luid = '$%s' % var
+        if tg_name not in self.target_groups:
+            lines.append('/usr/sbin/stmfadm create-tg %s' % tg_name)
+        # Yes, we add the target to its group before creating it;
+        # otherwise stmfadm complains that the target is already active.
+        if iscsi not in self.target_groups.get(tg_name, ()):
+            lines.append('/usr/sbin/stmfadm add-tg-member -g %s %s' % (
+                tg_name, iscsi))
+        if iscsi not in self.targets:
+            lines.append('/usr/sbin/itadm create-target -n %s' % iscsi)
+        if luid not in self.views:
+            lines.append('/usr/sbin/stmfadm add-view -t %s %s' % (tg_name,
+                                                                  luid))
+        return lines
+
+    def unexport_commands(self, server, volume_id):
+        zvol_name = server._build_zvol_name(volume_id)
+        iscsi = server._build_iscsi_target_name(volume_id)
+        tg_name = 'tg-%s' % server._build_volume_name(volume_id)
+        luid = self.lus.get(zvol_name)
+        lines = []
+        if luid in self.views:
+            lines.append('/usr/sbin/stmfadm remove-view -l %s -a' % luid)
+        if iscsi in self.targets:
+            lines.append('/usr/sbin/stmfadm offline-target %s' % iscsi)
+            lines.append('/usr/sbin/itadm delete-target %s' % iscsi)
         # We don't delete the tg-member; we delete the whole tg!
-        if self._target_group_exists(tg_name):
-            self._execute('/usr/sbin/stmfadm', 'delete-tg', tg_name)
-        if self._is_lu_created(volume):
-            self._execute('/usr/sbin/sbdadm', 'delete-lu', luid)
+        if tg_name in self.target_groups:
+            lines.append('/usr/sbin/stmfadm delete-tg %s' % tg_name)
+        if luid:
+            lines.append('/usr/sbin/sbdadm delete-lu %s' % luid)
+        return lines
 
 class Volume(object):
     """Controller for volume information."""
-    def __init__(self, id):
+    def __init__(self, id, db=None):
         self.id = int(id)
-        data = self._get_db_data(id)
+        self.db = db if db else _volume_db
+        data = self.db.get(self.id)
         self.host = data['host']
         self.size = int(data['size'])
         self.display_name = data['display_name']
         self.user_id = data['user_id']
         self.db_status = data['status']
 
-    def _get_db_data(self, id):
-        cmd = ['ssh', 'm3-p', './get_volume', id]
-        txt = subprocess.check_output(cmd)
-        rows = _tbl_text(txt) 
-        return rows[0] 
-
     def status(self, servers):
-        columns = ["ID", "Display Name", "Size", "User ID", "DB Status"]
-        column_renames = {}
-        formatters = {}
-            
-        def format_snaps(server):
-            def snaps (volume):
-                snapshots = server.volume_migrate_snapshots(volume)
-                return ", ".join([ s['NAME'] for s in snapshots ])
-            return snaps
-
+        """Migrate snapshot state of this volume on every server."""
+        primary = None
+        row = {'id': self.id, 'display_name': self.display_name,
+               'size': self.size, 'db_status': self.db_status,
+               'servers': {}}
         for server in servers:
-            column_name = server.host
+            numbers = server.snapshot_numbers(self)
+            row['servers'][server.host] = {
+                'count': len(numbers),
+                'newest': numbers[-1] if numbers else 0}
             if server.service_host == self.host:
-                column_name += " (Main)"
-            columns.append(column_name)
-            formatters[column_name] = format_snaps(server)
-        
-        align = max(map(len, columns))
-        for column in columns:
-            attr = column.lower().replace(' ', '_')
-            if column in column_renames:
-                attr = column_renames[column] 
-            if column in formatters:
-                text = formatters[column](self)
-            else:
-                text = getattr(self, attr, "")
-            print "%s: %s" % (string.rjust(column, align), text)
+                primary = server
+        row['primary'] = primary.host if primary else self.host
+        # How many snapshots each copy trails the primary's newest by.
+        row['lag'] = {}
+        if primary:
+            newest = row['servers'][primary.host]['newest']
+            for server in servers:
+                if server is not primary:
+                    common = primary.common_snapshot_number(server, self)
+                    row['lag'][server.host] = newest - common
+        return row
 
     def is_locked(self):
         return True if self.db_status == 'deleted' else False
 
     def lock(self):
-        id = str(self.id)
-        cmd = ['ssh', 'm3-p', './reset_volume_state', 'deleted', id]
-        subprocess.check_call(cmd)
+        lock_volumes([self])
 
     def unlock(self):
-        id = str(self.id)
-        cmd = ['ssh', 'm3-p', './reset_volume_state', 'detached', id]
-        subprocess.check_call(cmd)
+        unlock_volumes([self])
         
-    def stage(self, source, dest, skip_snapshot=False):
-        current_host = self.host
+    def stage(self, source, dest, skip_snapshot=False, **transfer):
         if not source:
-            Exception("Unknown server for %s" % (self.host))
+            raise Exception("Unknown server for %s" % (self.host))
         if not dest:
-            Exception("Unknown server for %s" % (args.destionation))
-        snap_name = None
-        if skip_snapshot:
-            snap_name = source.max_snapshot_name(self)
-        else:
-            snap_name = source.snapshot(self)
-        if not snap_name:
-            Exception("Failed to create snapshot on %s" % (self.host))
-        source.send_snapshot(dest, self, snap_name)
+            raise Exception("Unknown destination server")
+        with trace('stage', volume=self.id, host=source.host,
+                   dest=dest.host) as event:
+            snap_name = None
+            if skip_snapshot:
+                snap_name = source.max_snapshot_name(self)
+            else:
+                snap_name = source.snapshot(self)
+            if not snap_name:
+                raise Exception("Failed to create snapshot on %s" % (
+                    self.host))
+            event['bytes'] = source.send_snapshot(dest, self, snap_name,
+                                                  **transfer)
+        return event['bytes']
+
+    def verify_digests(self, dest):
+        """Check the stream digests recorded on dest's migrate snapshots.
+
+        Raise if any snapshot was received with a digest different from
+        the one sent; warn if the newest carries no digest at all.
+        """
+        snapshots = [dest._volume_snapshot_name(self, count)
+                     for count in dest.snapshot_numbers(self)]
+        if not snapshots:
+            return
+        with trace('verify', volume=self.id, host=dest.host):
+            values = dest.get_properties(snapshots,
+                                         [DIGEST_SENT, DIGEST_RECEIVED])
+        for snapshot in snapshots:
+            sent = values.get((snapshot, DIGEST_SENT), '-')
+            received = values.get((snapshot, DIGEST_RECEIVED), '-')
+            if sent != received:
+                raise Exception("%s: stream digest mismatch (sent %s, "
+                                "received %s); not switching exports." % (
+                                    snapshot, sent, received))
+        if values.get((snapshots[-1], DIGEST_SENT), '-') == '-':
+            print "warning: %s has no stream digest recorded" % snapshots[-1]
 
     def _update_exports(self, source, dest):
         """Destory source and construct dest iscsi exports; update the db."""
-        source.remove_export(self)
-        source.create_export(self)
-        # Update the database
-        host = dest.service_host
-        iqn = '"%s"' % dest.volume_iqn(self)
-        cmd = ['ssh', 'm3-p', './volume_migrate', str(self.id), host, iqn]
+        with trace('update_exports', volume=self.id, host=source.host,
+                   dest=dest.host):
+            source.remove_export(self)
+            dest.create_export(self)
+            self._update_db_host(dest)
+
+    def _update_db_host(self, dest):
+        update_db_hosts([self], dest)
         
-    def migrate(self, dest, skip_transfer=False):
+    def migrate(self, source, dest, skip_transfer=False, verify=True,
+                **transfer):
         if not self.is_locked():
-            Exception("You must lock a volume before migrating it.")
-        destination_snapshots = dest.volume_migrate_snapshots(self)
-        if skip_transfer and len(destination_snapshots) == 0:
-            Exception("You must send a snapshot before you can migrate.")
-        source = self.servers.get_server(self.host)
-        if not skip_transfer:
-            self.stage(source, dest)
+            raise Exception("You must lock a volume before migrating it.")
+        with trace('migrate', volume=self.id, host=source.host,
+                   dest=dest.host) as event:
+            destination_snapshots = dest.volume_migrate_snapshots(self)
+            if skip_transfer and len(destination_snapshots) == 0:
+                raise Exception("You must send a snapshot before you can "
+                                "migrate.")
+            if not skip_transfer:
+                event['bytes'] = self.stage(source, dest, **transfer)
+            if verify:
+                self.verify_digests(dest)
+            self._update_exports(source, dest)
+
+    def converge(self, source, dest, threshold, max_rounds=10, verify=True,
+                 force=False, **transfer):
+        """Send incrementals until the delta is small, then migrate.
+
+        Each round takes a new migrate snapshot and sends it while the
+        volume is still in use. Rounds stop once the data written since
+        the last snapshot is under threshold, or the per-round deltas stop
+        shrinking; only then is the volume locked for the last send and
+        the export switch-over. Running out of rounds first is an error
+        unless force is set, as the final send could hold the lock for
+        long.
+        """
+        if max_rounds < 1:
+            raise ValueError("max_rounds must be at least 1")
+        previous, rate = None, None
+        for round in range(1, max_rounds + 1):
+            snap_name = source.snapshot(self)
+            base = source.common_snapshot_number(dest, self)
+            increment = None
+            if base:
+                increment = source._volume_snapshot_name(self, base)
+            delta = source.estimate_send_size(snap_name, increment)
+            start = time.time()
+            sent = source.send_snapshot(dest, self, snap_name, **transfer)
+            elapsed = time.time() - start
+            if elapsed > 0 and sent:
+                rate = sent / elapsed
+            if delta is None:
+                # No dry-run estimate; go by what was actually sent.
+                delta = sent
+            pending = source.written_since(snap_name)
+            print "round %d: delta %s sent in %.1fs (%s/s), %s written " \
+                  "since" % (round, _format_size(delta), elapsed,
+                             _format_size(rate or 0), _format_size(pending))
+            if pending <= threshold:
+                break
+            if previous is not None and delta >= previous:
+                print "round %d: delta stopped shrinking" % round
+                break
+            previous = delta
+        else:
+            if not force:
+                raise Exception("Volume %d did not converge in %d rounds; "
+                                "%s still to send. Not locking." % (
+                                    self.id, max_rounds,
+                                    _format_size(pending)))
+            print "max rounds reached, locking anyway"
+        if rate:
+            print "predicted lock downtime: %.1fs for %s" % (
+                pending / rate, _format_size(pending))
+        self.lock()
+        locked = time.time()
+        try:
+            with trace('final_sync', volume=self.id, host=source.host,
+                       dest=dest.host) as event:
+                event['bytes'] = self.stage(source, dest, **transfer)
+        except Exception:
+            self.unlock()
+            raise
+        if verify:
+            self.verify_digests(dest)
         self._update_exports(source, dest)
+        print "volume %d locked for %.1fs" % (self.id, time.time() - locked)
 
     def _build_snapshot_range(self, snapshots):
         snapshots = [s['NAME'] for s in snapshots]
@@ -519,48 +1315,997 @@ class Volume(object):
         subject = subject_template % (self.display_name, self.id)
         send_mail(sender, [user.email], subject, message)
 
+class TransferError(Exception):
+    pass
+
+class Throttle(object):
+    """Rate in bytes/sec for a stream; None is unlimited.
+
+    The source's relay filter enforces it; SnapshotTransfer passes on
+    changes.
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+class AdaptiveThrottle(Throttle):
+    """Throttle that backs off while the servers' disks are busy.
+
+    A background thread samples the busiest disk on each server. Above
+    busy_high percent busy the rate is halved, below busy_low it grows
+    by a quarter, always within [min_rate, max_rate]. It starts at
+    min_rate so a transfer begun during business hours ramps up gently.
+    """
+    def __init__(self, servers, min_rate, max_rate, busy_high=80,
+                 busy_low=50, log=sys.stderr, name=''):
+        Throttle.__init__(self, min_rate)
+        self.servers = servers
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.busy_high = busy_high
+        self.busy_low = busy_low
+        self.log = log
+        self.name = name
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                busy = max(s.disk_busy() for s in self.servers)
+            except Exception, e:
+                print >>self.log, "%s: unable to sample load: %s" % (
+                    self.name, e)
+                self._stop.wait(DISK_SAMPLE_INTERVAL)
+                continue
+            if self._stop.is_set():
+                return
+            self.adjust(busy)
+            self._stop.wait(DISK_SAMPLE_INTERVAL)
+
+    def adjust(self, busy):
+        rate = self.rate
+        if busy > self.busy_high:
+            rate = max(self.min_rate, int(rate * 0.5))
+        elif busy < self.busy_low:
+            rate = min(self.max_rate, int(rate * 1.25))
+        if rate != self.rate:
+            print >>self.log, "%s: disks %d%% busy, rate %s/s -> %s/s" % (
+                self.name, busy, _format_size(self.rate), _format_size(rate))
+            self.set_rate(rate)
+
+class SnapshotTransfer(object):
+    """Stream one zfs send from source to dest over the migration link.
+
+    The whole pipeline runs on the source: zfs send, RELAY_FILTER to
+    buffer and rate limit it, and ssh to the destination's migration
+    interface into 'zfs recv -s'. Only progress, digests and errors come
+    back to this host. A dropped connection leaves a resume token on
+    dest; the next attempt continues from it with 'zfs send -t'.
+    """
+    def __init__(self, source, dest, volume, snapshot_name, compress=None,
+                 buffer_size=None, rate=None, adaptive=None,
+                 busy_high=80, busy_low=50, digest=True, retries=2,
+                 interval=10, log=sys.stderr):
+        self.source = source
+        self.dest = dest
+        self.volume = volume
+        self.snapshot_name = snapshot_name
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.digest = digest
+        if adaptive:
+            min_rate, max_rate = adaptive
+            self.throttle = AdaptiveThrottle([source, dest], min_rate,
+                                             max_rate, busy_high=busy_high,
+                                             busy_low=busy_low, log=log,
+                                             name=snapshot_name)
+        else:
+            self.throttle = Throttle(rate)
+        self.retries = retries
+        self.interval = interval
+        self.log = log
+        self.bytes = 0
+        self.elapsed = 0
+
+    def _say(self, message):
+        print >> self.log, "%s: %s" % (self.snapshot_name, message)
+
+    def _received(self):
+        number = _migrate_number(self.snapshot_name)
+        return number in self.dest.snapshot_numbers(self.volume)
+
+    def _commands(self, token):
+        increment = None
+        if not token:
+            inc = self.source.common_snapshot_number(self.dest, self.volume)
+            if inc != 0:
+                increment = self.source._volume_snapshot_name(self.volume,
+                                                              inc)
+        send = [self.source.send_command(self.snapshot_name, increment,
+                                         token)]
+        recv = [['zfs', 'recv', '-s', self.dest.volume_pool_name(self.volume)]]
+        if self.digest:
+            # Digest the raw stream, outside any compression.
+            send.append(DIGEST_FILTER + ['send'])
+            recv.insert(0, DIGEST_FILTER + ['recv'])
+        expected = None
+        if not self.compress:
+            expected = self.source.estimate_send_size(self.snapshot_name,
+                                                      increment, token)
+        else:
+            compress, decompress = COMPRESSORS[self.compress]
+            send.append(compress)
+            recv.insert(0, decompress)
+        return send, recv, expected
+
+    def run(self):
+        """Transfer until dest has the snapshot; return bytes sent."""
+        start = time.time()
+        self.throttle.start()
+        try:
+            self._run()
+        finally:
+            self.throttle.stop()
+        self.elapsed = time.time() - start
+        return self.bytes
+
+    def _run(self):
+        failures = 0
+        while not self._received():
+            token = self.dest.receive_resume_token(self.volume)
+            send, recv, expected = self._commands(token)
+            print "%s %s | ssh %s %s" % (
+                self.source.host, _describe(_pipeline(send)),
+                self.dest.migrate_iface, _describe(_pipeline(recv)))
+            try:
+                sent, started = self.bytes, time.time()
+                digests = self._relay(send, recv, expected)
+                record = {'time': started, 'volume': self.volume.id,
+                          'source': self.source.host,
+                          'dest': self.dest.host,
+                          'snapshot': self.snapshot_name,
+                          'bytes': self.bytes - sent,
+                          'seconds': time.time() - started}
+                if digests:
+                    record.update({'resumed': bool(token),
+                                   'sent_sha256': digests[0][0],
+                                   'received_sha256': digests[1][0]})
+                _record_transfer(record)
+            except TransferError, e:
+                failures += 1
+                self._say("transfer failed: %s" % e)
+                if failures > self.retries:
+                    raise
+                self._say("retrying (%d of %d)" % (failures, self.retries))
+                continue
+            if digests:
+                self._check_digests(digests, token)
+            if token:
+                # A resumed stream may have been for an earlier snapshot.
+                self.dest.refresh_snapshots(self.volume)
+            else:
+                self.dest._index_snapshots([self.snapshot_name.replace(
+                    self.source.volume_pool_name(self.volume),
+                    self.dest.volume_pool_name(self.volume), 1)])
+
+    def _check_digests(self, digests, token):
+        """Record both ends' stream digests; raise if they differ.
+
+        A resumed stream only covers the bytes after the resume point and
+        may belong to an earlier snapshot, so it is checked but not
+        recorded on the snapshot.
+        """
+        (sent, sent_len), (received, received_len) = digests
+        if not token:
+            dest_name = self.snapshot_name.replace(
+                self.source.volume_pool_name(self.volume),
+                self.dest.volume_pool_name(self.volume), 1)
+            self.source.set_properties(self.snapshot_name,
+                                       {DIGEST_SENT: sent})
+            self.dest.set_properties(dest_name, {DIGEST_SENT: sent,
+                                                 DIGEST_RECEIVED: received})
+        if (sent, sent_len) != (received, received_len):
+            raise Exception("%s: stream digest mismatch: sent %s (%d "
+                            "bytes), received %s (%d bytes)" % (
+                                self.snapshot_name, sent, sent_len,
+                                received, received_len))
+        self._say("sha256 %s verified on %s" % (sent, self.dest.host))
+
+    def _source_script(self, send, recv, rate_file):
+        """Shell pipeline run on the source for one attempt.
+
+        Each leg echoes its exit status to stderr as it finishes, so the
+        first one to fail can be told from those that failed because of
+        it.
+        """
+        filters = send[1:]
+        if self._relaying():
+            filters.append(RELAY_FILTER + [
+                str(TRANSFER_CHUNK), str(self.buffer_size or TRANSFER_BUFFER),
+                str(self.interval), rate_file or '-'])
+        ssh = ['ssh', '-o', 'BatchMode=yes', self.dest.migrate_iface,
+               pipes.quote(_pipeline(recv))]
+        # The send status is zfs send's own, not that of the digest or
+        # compression filters after it, which exit 0 on a short stream.
+        return " | ".join(
+            ['{ %s; echo "%s send $?" >&2; }' % (_pipeline(send[:1]),
+                                                TRANSFER_STATUS)] +
+            ([_pipeline(filters)] if filters else []) +
+            ['{ %s; echo "%s recv $?" >&2; }' % (" ".join(ssh),
+                                                TRANSFER_STATUS)])
+
+    def _relaying(self):
+        """Whether RELAY_FILTER runs on the source for this transfer.
+
+        It needs python there, as the digest filter does; without a rate,
+        buffer or digest the source runs zfs send and ssh alone.
+        """
+        return bool(self.throttle.rate or self.buffer_size or self.digest)
+
+    def _set_rate(self, rate_file, rate):
+        self.source.session.run(['echo', str(int(rate)), '>', rate_file])
+
+    def _relay(self, send, recv, expected):
+        """Run the transfer on the source; return both ends' digests."""
+        rate_file = None
+        if self.throttle.rate and self._relaying():
+            # One file per transfer; a batch runs many from one source.
+            rate_file = self.source.session.execute(
+                ['mktemp', '/tmp/migrate-rate.XXXXXX']).strip()
+            self._set_rate(rate_file, self.throttle.rate)
+        rate = self.throttle.rate
+        with open(os.devnull, 'r+') as null:
+            proc = self.source.session.popen(
+                [self._source_script(send, recv, rate_file)], stdin=null,
+                stdout=null, stderr=subprocess.PIPE)
+        start = time.time()
+        sent = 0
+        statuses, digests, errors = [], [], []
+        try:
+            for line in iter(proc.stderr.readline, ''):
+                parts = line.split()
+                if len(parts) == 2 and parts[0] == 'relayed':
+                    self.bytes += int(parts[1]) - sent
+                    sent = int(parts[1])
+                    self._progress(sent, expected, time.time() - start)
+                    if rate_file and self.throttle.rate != rate:
+                        rate = self.throttle.rate
+                        self._set_rate(rate_file, rate)
+                elif len(parts) == 3 and parts[0] == TRANSFER_STATUS:
+                    statuses.append((parts[1], int(parts[2])))
+                elif parts[:1] == ['sha256']:
+                    digests.append(line)
+                else:
+                    errors.append(line)
+            proc.wait()
+            if not self._relaying():
+                # Nothing counts the bytes; go by the estimate.
+                self.bytes += expected or 0
+        finally:
+            if rate_file:
+                self.source.session.run(['rm', '-f', rate_file],
+                                        check=False)
+        errors = "".join(errors).strip()
+        # The first leg to fail is the cause; the other one fails after it
+        # on a broken pipe or a truncated stream.
+        for leg, returncode in statuses:
+            if returncode != 0:
+                host = (self.source.host if leg == 'send'
+                        else self.dest.migrate_iface)
+                raise TransferError("%s exited %d: %s" % (
+                    host, returncode, errors))
+        if proc.returncode != 0 or len(statuses) != 2:
+            raise TransferError("%s exited %d: %s" % (
+                self.source.host, proc.returncode, errors))
+        if not self.digest:
+            return None
+        digests = [_parse_digest("".join(digests), label)
+                   for label in ('send', 'recv')]
+        if None in digests:
+            self._say("warning: no stream digest reported, not verified")
+            return None
+        return digests
+
+    def _progress(self, sent, expected, elapsed):
+        rate = sent / elapsed if elapsed > 0 else 0
+        message = "%s sent, %s/s" % (_format_size(sent), _format_size(rate))
+        if expected and rate:
+            remaining = max(expected - sent, 0) / rate
+            message += ", %d%%, ETA %dm%02ds" % (
+                min(100, 100 * sent / expected), remaining // 60,
+                remaining % 60)
+        self._say(message)
+
+class TransferPlan(object):
+    """Predicted transfer size and time for staging volumes to dest.
+
+    Sizes come from the source without moving data: data written since
+    the newest common migrate snapshot for volumes already staged, or a
+    dry-run 'zfs send -nvP' of the newest snapshot plus what was written
+    after it for volumes that still need a full send. Times use the
+    throughput recorded in TRANSFER_LOG by earlier transfers.
+    """
+    def __init__(self, dest, default_rate, switch_time=30):
+        self.dest = dest
+        self.default_rate = default_rate
+        self.switch_time = switch_time
+        self.rows = []
+
+    def add(self, volume, source):
+        row = {'volume': volume.id, 'size': volume.size,
+               'source': source.host, 'common': 0, 'bytes': 0,
+               'kind': 'none'}
+        self.rows.append(row)
+        if source is self.dest:
+            return row
+        rate = _measured_rate(source, self.dest) or self.default_rate
+        common = source.common_snapshot_number(self.dest, volume)
+        newest = source.max_snapshot_number(volume)
+        vol_name = source.volume_pool_name(volume)
+        datasets = [vol_name]
+        props = ['referenced']
+        snap = None
+        if newest:
+            snap = source._volume_snapshot_name(volume, newest)
+            datasets.append(snap)
+            props.extend(['written@%s_%d' % (MIGRATE_SNAPSHOT_PREFIX, newest),
+                          'creation'])
+        values = source.get_properties(datasets, props)
+        written = int(values[(vol_name, props[1])]) if newest else 0
+        if common:
+            row['kind'] = 'incremental'
+            row['bytes'] = written
+            if newest > common:
+                base = source._volume_snapshot_name(volume, common)
+                row['bytes'] += source.estimate_send_size(snap, base)
+        elif newest:
+            row['kind'] = 'full'
+            row['bytes'] = source.estimate_send_size(snap) + written
+        else:
+            row['kind'] = 'full'
+            row['bytes'] = int(values[(vol_name, 'referenced')])
+        row['common'] = common
+        row['rate'] = rate
+        row['stage_time'] = row['bytes'] / float(rate)
+        # While staging, writes continue at the rate seen since the newest
+        # snapshot; that backlog is what the locked final send moves.
+        final = 0
+        if newest:
+            age = time.time() - int(values[(snap, 'creation')])
+            if age > 0:
+                final = written / age * row['stage_time']
+        row['final_bytes'] = final
+        row['downtime'] = final / float(rate) + self.switch_time
+        return row
+
+    def print_table(self):
+        fmt = "%8s %6s %8s %11s %6s %9s %9s %9s %10s"
+        print fmt % ('Volume', 'Size', 'Source', 'Kind', 'Base', 'Transfer',
+                     'Rate/s', 'Stage', 'Downtime')
+        for row in self.rows:
+            if row['kind'] == 'none':
+                print fmt % (row['volume'], "%dG" % row['size'],
+                             row['source'], 'on dest', '-', '-', '-', '-',
+                             '-')
+                continue
+            print fmt % (row['volume'], "%dG" % row['size'], row['source'],
+                         row['kind'], row['common'] or '-',
+                         _format_size(row['bytes']),
+                         _format_size(row['rate']),
+                         _format_duration(row['stage_time']),
+                         _format_duration(row['downtime']))
+        moving = [r for r in self.rows if r['kind'] != 'none']
+        print "%d volumes, %s to send, ~%s staging (one stream), " \
+              "~%s total lock downtime" % (len(moving),
+              _format_size(sum(r['bytes'] for r in moving)),
+              _format_duration(sum(r['stage_time'] for r in moving)),
+              _format_duration(sum(r['downtime'] for r in moving)))
+
+class SnapshotGC(object):
+    """Fleet-wide cleanup of migrate snapshots.
+
+    Lists each server's pool once, groups migrate snapshots by volume and
+    keeps, on each server, only the newest snapshot it shares with another
+    server (the base for the next incremental send). Volumes without a
+    peer lose all of their migrate snapshots. Destroys are batched into
+    remote scripts of batch_size datasets with at most `concurrency`
+    scripts running per server.
+    """
+    def __init__(self, servers, batch_size=50, concurrency=1,
+                 timeout=DESTROY_TIMEOUT):
+        self.servers = servers
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.doomed = {}    # host -> [(dataset, [numbers], used, written)]
+
+    def collect(self):
+        """Work out what to destroy, one listing per server in parallel."""
+        usage = _parallel(self.servers, lambda s: s.load_snapshot_index(
+                          properties=['used', 'written']))
+        # volume name -> {host: set of numbers}
+        volumes = {}
+        for server in self.servers:
+            for dataset, numbers in server._snapshot_index.iteritems():
+                name = dataset.split('/')[-1]
+                volumes.setdefault(name, {})[server.host] = (dataset,
+                                                             numbers)
+        for name, hosts in volumes.iteritems():
+            for host, (dataset, numbers) in hosts.iteritems():
+                peers = set()
+                for other, (_, other_numbers) in hosts.iteritems():
+                    if other != host:
+                        peers.update(other_numbers)
+                keep = numbers & peers
+                keep = set([max(keep)]) if keep else set()
+                destroy = sorted(numbers - keep)
+                if not destroy:
+                    continue
+                used = written = 0
+                for number in destroy:
+                    snap = "%s@%s_%d" % (dataset, MIGRATE_SNAPSHOT_PREFIX,
+                                         number)
+                    props = usage[host].get(snap, {})
+                    used += int(props.get('used', 0))
+                    written += int(props.get('written', 0))
+                self.doomed.setdefault(host, []).append(
+                    (dataset, destroy, used, written))
+
+    def print_report(self):
+        fmt = "%-10s %9s %10s %10s %10s"
+        print fmt % ('Server', 'Volumes', 'Snapshots', 'Used', 'Written')
+        totals = [0, 0, 0, 0]
+        for server in self.servers:
+            doomed = self.doomed.get(server.host, [])
+            row = [len(doomed), sum(len(d[1]) for d in doomed),
+                   sum(d[2] for d in doomed), sum(d[3] for d in doomed)]
+            totals = [a + b for a, b in zip(totals, row)]
+            print fmt % (server.host, row[0], row[1], _format_size(row[2]),
+                         _format_size(row[3]))
+        print fmt % ('total', totals[0], totals[1], _format_size(totals[2]),
+                     _format_size(totals[3]))
+        print "'used' is the space unique to each snapshot; destroying " \
+              "neighbouring snapshots together can free more."
+
+    def _destroy(self, server, chunks):
+        while True:
+            try:
+                chunk = chunks.get_nowait()
+            except Queue.Empty:
+                return
+            specs = ["%s@%s" % (dataset, ",".join(
+                        "%s_%d" % (MIGRATE_SNAPSHOT_PREFIX, n)
+                        for n in numbers))
+                     for dataset, numbers, used, written in chunk]
+            for spec in specs:
+                print server.host, "zfs destroy", spec
+            # Each destroy reports its own success; the script's exit
+            # status is only the last one's.
+            script = "".join("zfs destroy %s && echo 'destroyed %s'\n" % (
+                spec, spec) for spec in specs)
+            try:
+                returncode, out, err = server.session.run(
+                    ['sh', '-s'], input=script, timeout=self.timeout,
+                    check=False)
+            except Exception, e:
+                print >>sys.stderr, "%s: destroy failed: %s" % (server.host,
+                                                                e)
+                out, err = '', ''
+            destroyed = set(line.split(' ', 1)[1] for line in
+                            out.splitlines() if line.startswith('destroyed '))
+            for spec in specs:
+                if spec in destroyed:
+                    server._unindex_snapshots(spec)
+                else:
+                    print >>sys.stderr, "%s: destroy %s failed" % (
+                        server.host, spec)
+            if err.strip():
+                print >>sys.stderr, "%s: %s" % (server.host, err.strip())
+
+    def run(self):
+        threads = []
+        for server in self.servers:
+            doomed = self.doomed.get(server.host, [])
+            chunks = Queue.Queue()
+            for i in range(0, len(doomed), self.batch_size):
+                chunks.put(doomed[i:i + self.batch_size])
+            for i in range(self.concurrency):
+                threads.append(threading.Thread(target=self._destroy,
+                                                args=(server, chunks)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+class RebalancePlan(object):
+    """Even out capacity and I/O load across the volume servers.
+
+    Each server gets a score mixing how far its pool usage sits from the
+    fleet-wide usage and how far its share of the I/O bandwidth sits from
+    its share of the capacity. Moves go from the highest to the lowest
+    score, choosing the primary volume that best closes the gap without
+    overshooting it, so the plan moves as few bytes as it can. A volume's
+    I/O load is not measured on its own; it is taken as its share of its
+    server's used space.
+    """
+    def __init__(self, servers, load_weight=0.5, tolerance=0.05,
+                 reserve=0.1, max_moves=50):
+        self.servers = servers
+        self.load_weight = load_weight
+        self.tolerance = tolerance
+        self.reserve = reserve
+        self.max_moves = max_moves
+        self.stats = {}
+        self.volumes = {}   # host -> {volume id: bytes used}
+        self.moves = []
+
+    def collect(self, db=None):
+        self.stats = _parallel(self.servers, lambda s: s.pool_stats())
+        usage = _parallel(self.servers, lambda s: s.volume_usage())
+        ids = set()
+        for host_usage in usage.values():
+            ids.update(host_usage)
+        # Zvols with no DB row have no primary and are never moved.
+        rows = (db if db else _volume_db).get_many(sorted(ids), strict=False)
+        by_service = dict((s.service_host, s.host) for s in self.servers)
+        for server in self.servers:
+            # Only a volume's primary copy can be moved.
+            self.volumes[server.host] = dict(
+                (i, used) for i, used in usage[server.host].iteritems()
+                if i in rows and
+                by_service.get(rows[i]['host']) == server.host)
+        for host, stats in self.stats.iteritems():
+            stats['capacity'] = stats['used'] + stats['available']
+            stats['before'] = dict(stats)
+
+    def _scores(self):
+        capacity = sum(s['capacity'] for s in self.stats.values())
+        used = sum(s['used'] for s in self.stats.values())
+        load = sum(s['bandwidth'] for s in self.stats.values()) or 1
+        scores = {}
+        for host, s in self.stats.iteritems():
+            space = float(s['used']) / s['capacity'] - float(used) / capacity
+            busy = (float(s['bandwidth']) / load -
+                    float(s['capacity']) / capacity)
+            scores[host] = ((1 - self.load_weight) * space +
+                            self.load_weight * busy)
+        return scores
+
+    def plan(self):
+        while len(self.moves) < self.max_moves:
+            scores = self._scores()
+            src = max(scores, key=scores.get)
+            dst = min(scores, key=scores.get)
+            gap = scores[src] - scores[dst]
+            if src == dst or gap < self.tolerance:
+                break
+            s, d = self.stats[src], self.stats[dst]
+            # Bytes that would bring both scores together.
+            want = gap / (1.0 / s['capacity'] + 1.0 / d['capacity'])
+            room = d['available'] - self.reserve * d['capacity']
+            candidates = [(used, i) for i, used in
+                          self.volumes[src].iteritems() if used <= room]
+            fits = [c for c in candidates if c[0] <= want]
+            if fits:
+                used, volume_id = max(fits)
+            elif candidates and min(candidates)[0] < 2 * want:
+                used, volume_id = min(candidates)
+            else:
+                break
+            share = float(used) / s['used'] if s['used'] else 0
+            load = s['bandwidth'] * share
+            s['used'] -= used
+            s['available'] += used
+            s['bandwidth'] -= load
+            d['used'] += used
+            d['available'] -= used
+            d['bandwidth'] += load
+            del self.volumes[src][volume_id]
+            self.volumes[dst][volume_id] = used
+            self.moves.append((volume_id, src, dst, used))
+        return self.moves
+
+    def print_plan(self):
+        fmt = "%-10s %10s %10s %7s %10s %10s %7s %6s"
+        print fmt % ('Server', 'Capacity', 'Used', 'Used%', 'IO/s',
+                     'After', 'Used%', 'Ratio')
+        for server in self.servers:
+            s = self.stats[server.host]
+            b = s['before']
+            print fmt % (server.host, _format_size(s['capacity']),
+                         _format_size(b['used']),
+                         "%.1f" % (100.0 * b['used'] / s['capacity']),
+                         _format_size(b['bandwidth']),
+                         _format_size(s['used']),
+                         "%.1f" % (100.0 * s['used'] / s['capacity']),
+                         s['compressratio'])
+        print
+        print "%d moves, %s in total" % (len(self.moves), _format_size(
+            sum(m[3] for m in self.moves)))
+        for volume_id, src, dst, used in self.moves:
+            print "# volume %d: %s -> %s (%s)" % (volume_id, src, dst,
+                                                  _format_size(used))
+            print "stage %d %s" % (volume_id, dst)
+            print "lock %d" % volume_id
+            print "migrate %d %s" % (volume_id, dst)
+
+class MigrationBatch(object):
+    """Stage, lock, final sync and switch exports for many volumes.
+
+    Transfers hold a stream slot on both the source and the destination,
+    so at most `streams` zfs sends run against any one server at a time.
+    """
+    def __init__(self, servers, dest, streams=2, retries=1, transfer=None):
+        self.servers = servers
+        self.dest = dest
+        self.retries = retries
+        self.transfer = transfer if transfer else {}
+        self.results = {}
+        self._slots = dict((s.host, threading.BoundedSemaphore(streams))
+                           for s in servers.all())
+        self._print_lock = threading.Lock()
+
+    def _log(self, volume_id, message):
+        with self._print_lock:
+            print "[%s] volume %s: %s" % (time.strftime('%H:%M:%S'),
+                                          volume_id, message)
+            sys.stdout.flush()
+
+    def _transfer(self, source, fn, *args, **kwargs):
+        # Always take slots in host order so two workers can't deadlock.
+        slots = [self._slots[s.host]
+                 for s in sorted([source, self.dest], key=lambda s: s.host)]
+        for slot in slots:
+            slot.acquire()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            for slot in reversed(slots):
+                slot.release()
+
+    def _migrate_one(self, volume_id):
+        volume = Volume(volume_id)
+        source = self.servers.get_server(volume.host)
+        if source is self.dest:
+            self._log(volume_id, "already on %s, skipping" % self.dest.host)
+            return 'skipped'
+        self._log(volume_id, "staging %s -> %s" % (source.host,
+                                                    self.dest.host))
+        sent = self._transfer(source, volume.stage, source, self.dest,
+                              **self.transfer)
+        volume.lock()
+        try:
+            self._log(volume_id, "locked, final sync")
+            sent += self._transfer(source, volume.stage, source, self.dest,
+                                   **self.transfer)
+        except Exception:
+            volume.unlock()
+            raise
+        self._log(volume_id, "switching exports")
+        volume.migrate(source, self.dest, skip_transfer=True)
+        return sent
+
+    def _worker(self, queue):
+        while True:
+            try:
+                volume_id = queue.get_nowait()
+            except Queue.Empty:
+                return
+            result = {'attempts': 0, 'status': 'failed', 'bytes': 0}
+            start = time.time()
+            while result['attempts'] <= self.retries:
+                result['attempts'] += 1
+                try:
+                    sent = self._migrate_one(volume_id)
+                except Exception, e:
+                    result['error'] = str(e)
+                    self._log(volume_id, "attempt %d failed: %s" % (
+                        result['attempts'], e))
+                    continue
+                if sent == 'skipped':
+                    result['status'] = 'skipped'
+                else:
+                    result['status'] = 'migrated'
+                    result['bytes'] = sent
+                result.pop('error', None)
+                break
+            result['elapsed'] = time.time() - start
+            self._log(volume_id, "%s after %d attempt(s)" % (
+                result['status'], result['attempts']))
+            self.results[volume_id] = result
+
+    def run(self, volume_ids, workers=4):
+        queue = Queue.Queue()
+        for volume_id in volume_ids:
+            queue.put(volume_id)
+        start = time.time()
+        threads = [threading.Thread(target=self._worker, args=(queue,))
+                   for i in range(min(workers, len(volume_ids)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        self.elapsed = time.time() - start
+        return self.results
+
+    def print_summary(self):
+        print "%8s %9s %8s %10s %9s  %s" % ('Volume', 'Status', 'Attempts',
+                                            'Time(s)', 'Sent', 'Error')
+        for volume_id in sorted(self.results):
+            r = self.results[volume_id]
+            print "%8s %9s %8d %10.1f %9s  %s" % (volume_id, r['status'],
+                r['attempts'], r['elapsed'], _format_size(r['bytes']),
+                r.get('error', ''))
+        done = [r for r in self.results.values() if r['status'] == 'migrated']
+        failed = [r for r in self.results.values() if r['status'] == 'failed']
+        sent = sum(r['bytes'] for r in done)
+        rate = sent / self.elapsed if self.elapsed else 0
+        print "%d migrated, %d failed, %s sent in %.1f minutes (%s/s)" % (
+            len(done), len(failed), _format_size(sent), self.elapsed / 60.0,
+            _format_size(rate))
+
+def _transfer_args(func):
+    """CLI options shared by the commands that send snapshots."""
+    _add_arg(func, '--rate', type=_parse_size, default=None,
+             help='Cap each zfs send stream at RATE bytes/sec (e.g. 50M).')
+    _add_arg(func, '--adaptive', type=_parse_rate_range, metavar='MIN:MAX',
+             help='Adjust each stream between MIN and MAX bytes/sec from '
+                  'the disk load on both servers.')
+    _add_arg(func, '--busy-high', type=int, default=80,
+             help='With --adaptive, back off above this %%busy '
+                  '(default 80).')
+    _add_arg(func, '--busy-low', type=int, default=50,
+             help='With --adaptive, speed up below this %%busy '
+                  '(default 50).')
+    _add_arg(func, '--no-digest', dest='digest', action='store_false',
+             help='Skip the sha256 of the stream on both ends. Without '
+                  '--rate, --adaptive or --buffer as well, the servers '
+                  'need no python.')
+    _add_arg(func, '--compress', choices=sorted(COMPRESSORS),
+             help='Compress the stream on the wire.')
+    _add_arg(func, '--buffer', type=_parse_size,
+             help='Relay buffer size (default 256M when relaying).')
+    _add_arg(func, '--resume-retries', type=int, default=2,
+             help='Times to resume an interrupted send (default 2).')
+    return func
+
+def _transfer_options(args):
+    return {'rate': args.rate, 'compress': args.compress,
+            'adaptive': args.adaptive, 'busy_high': args.busy_high,
+            'busy_low': args.busy_low, 'digest': args.digest,
+            'buffer_size': args.buffer,
+            'retries': args.resume_retries}
+
 class MigrateShell(Shell):
     
     def __init__(self, servers=[]):
         self.servers = servers
 
-    @arg('volume', help='Volume ID')
+    def get_base_parser(self):
+        parser = super(MigrateShell, self).get_base_parser()
+        parser.add_argument('--ssh-timeout', type=int,
+                            default=COMMAND_TIMEOUT,
+                            help='Timeout in seconds for each remote '
+                                 'command (default %d).' % COMMAND_TIMEOUT)
+        parser.add_argument('--ssh-stats', action='store_true',
+                            help='Print per-host ssh latency on exit.')
+        parser.add_argument('--trace', metavar='FILE',
+                            help='Append per-phase timing events to FILE '
+                                 'as JSON lines.')
+        return parser
+
+    def main(self, argv):
+        parser = self.get_subcommand_parser()
+        args = parser.parse_args(argv)
+        magellan_ssh.DEFAULT_TIMEOUT = args.ssh_timeout
+        if args.trace:
+            _tracer.open(args.trace, argv)
+        try:
+            args.func(self, args)
+        finally:
+            if args.ssh_stats:
+                magellan_ssh.print_stats()
+
+    @arg('volumes', nargs='*', help='Volume IDs')
+    @arg('--server', metavar='HOST',
+         help='Report every volume stored on HOST.')
+    @arg('--json', action='store_true', help='Print rows as JSON.')
     def do_status(self, args):
-        """Determine the status of a volume."""
-        Volume(args.volume).status(servers=self.servers.all())
+        """Determine the status of volumes."""
+        servers = self.servers.all()
+        volume_ids = [int(v) for v in args.volumes]
+        if args.server:
+            server = self.servers.get_server(args.server)
+            volume_ids.extend(i for i in server.volume_ids()
+                              if i not in volume_ids)
+        rows = _volume_db.get_many(volume_ids, strict=False)
+        for volume_id in volume_ids:
+            if volume_id not in rows:
+                print >> sys.stderr, "Skipping volume %d: not in the DB." % (
+                    volume_id)
+        volume_ids = [i for i in volume_ids if i in rows]
+        if not volume_ids:
+            raise Exception("No volumes given.")
+        volumes = load_volumes(volume_ids)
+        # One listing per server, all servers at once.
+        if len(volumes) > 1:
+            _parallel(servers, lambda s: s.load_snapshot_index())
+        else:
+            _parallel(servers, lambda s: s.snapshot_numbers(volumes[0]))
+        rows = [v.status(servers) for v in volumes]
+        if args.json:
+            print json.dumps(rows, indent=2)
+            return
+        hosts = [s.host for s in servers]
+        fmt = "%8s %-20s %5s %-10s %-8s" + " %10s" * len(hosts) + "  %s"
+        print fmt % tuple(['ID', 'Display Name', 'Size', 'DB Status',
+                           'Primary'] + hosts + ['Lag'])
+        for row in rows:
+            snaps = ["%d@%d" % (row['servers'][h]['count'],
+                                row['servers'][h]['newest']) for h in hosts]
+            lag = ", ".join("%s:%d" % item for item in
+                            sorted(row['lag'].items()))
+            print fmt % tuple([row['id'], row['display_name'][:20],
+                               "%dG" % row['size'], row['db_status'],
+                               row['primary']] + snaps + [lag])
+        print "Snapshot columns are count@newest migrate_N."
     
-    @arg('volume', help='Volume ID')
+    @arg('volumes', nargs='+', help='Volume IDs')
     def do_lock(self, args):
         """Prevent a user from attaching it. (Mark as deleted.)"""
-        volume = Volume(args.volume)
-        volume.lock()
+        lock_volumes(load_volumes(args.volumes))
 
-    @arg('volume', help='Volume ID')
+    @arg('volumes', nargs='+', help='Volume IDs')
     def do_unlock(self, args):
         """Mark the volume as available."""
-        volume = Volume(args.volume)
-        volume.unlock()
+        unlock_volumes(load_volumes(args.volumes))
 
     @arg('volume', help='Volume ID')
     @arg('destination', help='Hostname of the destination machine')
     @arg('--skip', action='store_true',
          help='Skip creating another snapshot; just send the most recent one.')
+    @_transfer_args
     def do_stage(self, args):
         """Snapshot the volume and transfer that snapshot."""
         volume = Volume(args.volume)
         source = self.servers.get_server(volume.host)
         dest = self.servers.get_server(args.destination)
-        volume.stage(source, dest, skip_snapshot=args.skip)
+        volume.stage(source, dest, skip_snapshot=args.skip,
+                     **_transfer_options(args))
 
     @arg('volume', help='Volume ID')
     @arg('destination', help='Hostname of the destination machine')
     @arg('--skip', action='store_true',
          help='Skip the snapshot + trasfer step.')
+    @arg('--no-verify', dest='verify', action='store_false',
+         help='Switch exports even if the stream digests differ.')
+    @_transfer_args
     def do_migrate(self, args):
         """Transfer final snapshot and set dest as primary server."""
         volume = Volume(args.volume)
+        source = self.servers.get_server(volume.host)
+        dest = self.servers.get_server(args.destination)
+        volume.migrate(source, dest, skip_transfer=args.skip,
+                       verify=args.verify, **_transfer_options(args))
+
+    @arg('volume', help='Volume ID')
+    @arg('destination', help='Hostname of the destination machine')
+    @arg('--threshold', type=_parse_size, default=_parse_size('1G'),
+         help='Lock once less than this was written since the last '
+              'round (default 1G).')
+    @arg('--max-rounds', type=_positive_int, default=10,
+         help='Give up converging after this many rounds (default 10).')
+    @arg('--force', action='store_true',
+         help='Lock and migrate even if --max-rounds runs out first.')
+    @arg('--no-verify', dest='verify', action='store_false',
+         help='Switch exports even if the stream digests differ.')
+    @_transfer_args
+    def do_converge(self, args):
+        """Stage incrementals until the delta is small, then migrate."""
+        volume = Volume(args.volume)
+        source = self.servers.get_server(volume.host)
+        dest = self.servers.get_server(args.destination)
+        volume.converge(source, dest, args.threshold,
+                        max_rounds=args.max_rounds, verify=args.verify,
+                        force=args.force, **_transfer_options(args))
+
+    @arg('destination', help='Hostname of the destination machine')
+    @arg('volumes', nargs='+', help='Volume IDs')
+    @arg('--rate', type=_parse_size, default=_parse_size('50M'),
+         help='Throughput to assume when no earlier transfer was '
+              'recorded (default 50M/s).')
+    @arg('--switch-time', type=int, default=30,
+         help='Seconds to allow for the export switch-over (default 30).')
+    def do_plan(self, args):
+        """Estimate transfer size, staging time and lock downtime."""
+        dest = self.servers.get_server(args.destination)
+        plan = TransferPlan(dest, args.rate, switch_time=args.switch_time)
+        for volume in load_volumes(args.volumes):
+            plan.add(volume, self.servers.get_server(volume.host))
+        plan.print_table()
+
+    @arg('destination', help='Hostname of the destination machine')
+    @arg('volumes', nargs='+', help='Volume IDs')
+    @arg('--no-verify', dest='verify', action='store_false',
+         help='Switch exports even if the stream digests differ.')
+    def do_switch_exports(self, args):
+        """Move the exports of locked, staged volumes to destination."""
         dest = self.servers.get_server(args.destination)
-        volume.migrate(dest, skip_transfer=args.skip)
+        volumes = load_volumes(args.volumes)
+        by_source = {}
+        for volume in volumes:
+            if not volume.is_locked():
+                raise Exception("Volume %d is not locked." % volume.id)
+            if not dest.snapshot_numbers(volume):
+                raise Exception("Volume %d has no snapshot on %s." % (
+                    volume.id, dest.host))
+            if args.verify:
+                volume.verify_digests(dest)
+            source = self.servers.get_server(volume.host)
+            by_source.setdefault(source, []).append(volume)
+        for source, source_volumes in by_source.iteritems():
+            source.remove_exports(source_volumes)
+        dest.create_exports(volumes)
+        update_db_hosts(volumes, dest)
+
+    @arg('destination', help='Hostname of the destination machine')
+    @arg('volumes', nargs='*', help='Volume IDs')
+    @arg('--from-server', metavar='HOST',
+         help='Migrate every volume whose primary is HOST.')
+    @arg('--streams', type=int, default=2,
+         help='Concurrent zfs send streams per server (default 2).')
+    @arg('--workers', type=int, default=4,
+         help='Volumes in flight at once (default 4).')
+    @arg('--retries', type=int, default=1,
+         help='Retries for a failed volume (default 1).')
+    @_transfer_args
+    def do_migrate_batch(self, args):
+        """Stage, lock and migrate many volumes to one destination."""
+        dest = self.servers.get_server(args.destination)
+        volume_ids = [int(v) for v in args.volumes]
+        if args.from_server:
+            source = self.servers.get_server(args.from_server)
+            # The pool also holds staged copies of volumes whose primary
+            # is elsewhere; only take the ones the DB puts on source.
+            pool_ids = source.volume_ids()
+            rows = _volume_db.get_many(pool_ids, strict=False)
+            volume_ids.extend(i for i in pool_ids if i not in rows or (
+                rows[i]['host'] == source.service_host and
+                i not in volume_ids))
+        rows = _volume_db.get_many(volume_ids, strict=False)
+        for volume_id in volume_ids:
+            if volume_id not in rows:
+                print >> sys.stderr, "Skipping volume %d: not in the DB." % (
+                    volume_id)
+        volume_ids = [i for i in volume_ids if i in rows]
+        if not volume_ids:
+            raise Exception("No volumes given.")
+        batch = MigrationBatch(self.servers, dest, streams=args.streams,
+                               retries=args.retries,
+                               transfer=_transfer_options(args))
+        batch.run(volume_ids, workers=args.workers)
+        batch.print_summary()
 
     @arg('volume', help='Volume ID')
     @arg('-m', '--message', type=str, help='Message to send to the user')
@@ -578,6 +2323,57 @@ class MigrateShell(Shell):
         volume = Volume(args.volume)
         volume.cleanup(servers, do_snapshots=True, do_volume=args.delete)
 
+    @arg('--load-weight', type=float, default=0.5,
+         help='Weight of I/O load against capacity, 0 to 1 (default 0.5).')
+    @arg('--tolerance', type=float, default=0.05,
+         help='Stop once server scores are this close (default 0.05).')
+    @arg('--reserve', type=float, default=0.1,
+         help='Fraction of a pool to keep free (default 0.1).')
+    @arg('--max-moves', type=int, default=50,
+         help='Most volumes to move (default 50).')
+    @arg('--json', action='store_true', help='Print the moves as JSON.')
+    def do_rebalance(self, args):
+        """Plan moves that even out capacity and load across servers."""
+        plan = RebalancePlan(self.servers.all(), load_weight=args.load_weight,
+                             tolerance=args.tolerance, reserve=args.reserve,
+                             max_moves=args.max_moves)
+        plan.collect()
+        plan.plan()
+        if args.json:
+            print json.dumps([{'volume': v, 'source': src, 'dest': dst,
+                               'bytes': used}
+                              for v, src, dst, used in plan.moves], indent=2)
+        else:
+            plan.print_plan()
+
+    @arg('--dry-run', action='store_true',
+         help='Only report what would be destroyed.')
+    @arg('--batch-size', type=int, default=50,
+         help='Volumes per remote destroy script (default 50).')
+    @arg('--concurrency', type=int, default=1,
+         help='Destroy scripts running at once per server (default 1).')
+    @arg('--destroy-timeout', type=int, default=DESTROY_TIMEOUT,
+         help='Seconds one destroy script may run (default %(default)s).')
+    def do_gc(self, args):
+        """Destroy migrate snapshots no longer needed on any server."""
+        gc = SnapshotGC(self.servers.all(), batch_size=args.batch_size,
+                        concurrency=args.concurrency,
+                        timeout=args.destroy_timeout)
+        gc.collect()
+        gc.print_report()
+        if not args.dry_run:
+            gc.run()
+
+    @arg('files', nargs='+', metavar='FILE', help='Trace files (--trace)')
+    @arg('--by', choices=['host', 'dest', 'volume', 'run'],
+         help='Break each phase down by this field.')
+    def do_report(self, args):
+        """Summarize where migration time went from trace files."""
+        report = TraceReport(group_by=args.by)
+        for path in args.files:
+            report.load(path)
+        report.print_table()
+
     def do_servers(self, args):
         """List configured servers."""
         servers = self.servers.all()